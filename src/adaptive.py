@@ -0,0 +1,116 @@
+import math
+from main import logger
+
+# Defaults for the 'adaptive' section of detector.json
+DEFAULT_LATENCY_BUDGET_MS = 30
+DEFAULT_MIN_TAG_PIXELS = 20 # Smallest tag edge, after decimation, that still decodes
+DEFAULT_HOLD_FRAMES = 10 # Frames to stay on a profile before switching again
+DEFAULT_SMOOTHING = 0.2 # Weight of the newest latency measurement
+DEFAULT_PROFILES = [
+    {'quad_decimate': 1},
+    {'quad_decimate': 1.5},
+    {'quad_decimate': 2},
+    {'quad_decimate': 3}
+]
+
+# Detector settings that can be changed while running
+_RUNTIME_SETTINGS = {
+    'nthreads': int,
+    'quad_decimate': float,
+    'quad_sigma': float,
+    'refine_edges': int,
+    'refine_decode': int,
+    'refine_pose': int
+}
+
+def apply_settings(detector, settings):
+    # Changes settings of an apriltag.Detector without creating a new one
+    for key, value in settings.items():
+        if key not in _RUNTIME_SETTINGS:
+            raise ValueError(f"Detector setting '{key}' can't be changed while running")
+        setattr(detector.tag_detector.contents, key, _RUNTIME_SETTINGS[key](value))
+
+def tag_pixel_size(result):
+    # Edge length of a square with the same area as the tag in the image
+    x, y = result.corners[:, 0], result.corners[:, 1]
+    area = 0.5 * abs(sum(x[i] * y[i - 1] - x[i - 1] * y[i] for i in range(4)))
+    return math.sqrt(area)
+
+
+class AdaptiveController:
+    # Switches between detector profiles, ordered from finest to coarsest, to
+    # stay within a latency budget while still resolving the smallest tag in
+    # view. Coarse profiles are used when tags are big, fine ones when they
+    # are far away or have been lost. Keep one per camera.
+    def __init__(self, options, base_settings, name):
+        self.name = name
+        self.budget = options.get('latency_budget_ms', DEFAULT_LATENCY_BUDGET_MS) / 1000
+        self.min_tag_pixels = options.get('min_tag_pixels', DEFAULT_MIN_TAG_PIXELS)
+        self.hold_frames = options.get('hold_frames', DEFAULT_HOLD_FRAMES)
+        self.smoothing = options.get('smoothing', DEFAULT_SMOOTHING)
+
+        # Profiles only list what they change from detector.json
+        self.profiles = options.get('profiles', DEFAULT_PROFILES)
+        if not self.profiles:
+            raise ValueError("Adaptive detection needs at least one profile")
+        self.decimates = [profile.get('quad_decimate', base_settings.get('quad_decimate', 1))
+                          for profile in self.profiles]
+
+        # Settings a profile leaves out go back to what detector.json says
+        self.base = {key: value for key, value in base_settings.items() if key in _RUNTIME_SETTINGS}
+
+        self.index = 0
+        self.latencies = [None] * len(self.profiles) # Smoothed seconds per frame
+        self.frames_on_profile = 0
+        self.frames_without_tags = 0
+        self.smallest_tag = None
+
+    def apply(self, detector):
+        apply_settings(detector, {**self.base, **self.profiles[self.index]})
+
+    def latency(self):
+        return self.latencies[self.index]
+
+    def _fits_budget(self, index):
+        # Profiles that haven't been measured yet are worth trying
+        return self.latencies[index] is None or self.latencies[index] <= self.budget
+
+    def update(self, seconds, results):
+        # Record how the last frame went and pick the profile for the next one
+        latency = self.latencies[self.index]
+        if latency is None:
+            self.latencies[self.index] = seconds
+        else:
+            self.latencies[self.index] = latency + self.smoothing * (seconds - latency)
+
+        if results:
+            self.smallest_tag = min(tag_pixel_size(result) for result in results)
+            self.frames_without_tags = 0
+        else:
+            self.frames_without_tags += 1
+
+        self.frames_on_profile += 1
+        if self.frames_on_profile < self.hold_frames:
+            return
+
+        if self.frames_without_tags == 0:
+            # Coarsest profile that still sees the smallest tag
+            resolving = [i for i, decimate in enumerate(self.decimates)
+                         if self.smallest_tag / decimate >= self.min_tag_pixels]
+            target = max(resolving) if resolving else 0
+        elif self.frames_without_tags >= self.hold_frames:
+            # Look harder for tags that might be too far away to see
+            target = self.index - 1
+        else:
+            target = self.index
+
+        # Staying on time is more important than range
+        target = max(target, 0)
+        while target < len(self.profiles) - 1 and not self._fits_budget(target):
+            target += 1
+
+        # Move one step at a time so a single odd frame can't jump far
+        if target != self.index:
+            self.index += 1 if target > self.index else -1
+            self.frames_on_profile = 0
+            logger.info(f"{self.name} switched to detector profile {self.index} {self.profiles[self.index]}")
@@ -0,0 +1,134 @@
+import cv2
+import numpy as np
+from environment import invert_rigid
+from joint_solver import CameraModel
+
+# Defaults for the 'ambiguity' section of solver.json
+DEFAULT_ERROR_RATIO = 5 # Second pose reprojecting this many times worse is simply wrong
+DEFAULT_PRIOR_TIMEOUT = 0.5 # Seconds the last solved robot pose still decides
+DEFAULT_ROTATION_WEIGHT = 1 # Meters one radian of robot rotation counts as
+DEFAULT_CHOICE_TIMEOUT = 1 # Seconds a tag's last choice is remembered
+
+# Corners of a tag of size 1 in the order IPPE_SQUARE needs them. These are
+# apriltag's corners 3, 2, 1, 0 in the same tag frame.
+_IPPE_CORNERS = np.array([
+    [-0.5,  0.5, 0],
+    [ 0.5,  0.5, 0],
+    [ 0.5, -0.5, 0],
+    [-0.5, -0.5, 0]
+], dtype=np.float64)
+_IPPE_ORDER = [3, 2, 1, 0]
+
+# How the pose of a tag was picked
+CHOICE_CLEAR = 'clear' # Only one pose reprojects well
+CHOICE_PRIOR = 'prior' # Closest to the last solved robot pose
+CHOICE_TAGS = 'tags' # Agrees best with other tags in the frame
+CHOICE_STICKY = 'sticky' # Same as last time this tag was seen
+CHOICE_ERROR = 'error' # Nothing else to go on, lowest reprojection error
+
+def _rotation_angles(a, b):
+    # Angles in radians between stacked rotations
+    cosines = (np.einsum('...ij,...ij->...', a, b) - 1) / 2
+    return np.arccos(np.clip(cosines, -1, 1))
+
+
+class AmbiguityResolver:
+    # A square tag seen head on or far away fits two poses, tilted towards
+    # and away from the camera, almost equally well. This finds both with
+    # IPPE and picks one by reprojection error when that is clear, otherwise
+    # by the last robot pose, by the other tags in the frame, or by what was
+    # picked for the tag last time, in that order.
+    def __init__(self, environment, options):
+        self.environment = environment
+        self.error_ratio = options.get('error_ratio', DEFAULT_ERROR_RATIO)
+        self.prior_timeout = options.get('prior_timeout', DEFAULT_PRIOR_TIMEOUT)
+        self.rotation_weight = options.get('rotation_weight', DEFAULT_ROTATION_WEIGHT)
+        self.choice_timeout = options.get('choice_timeout', DEFAULT_CHOICE_TIMEOUT)
+
+        self.cameras = {} # CameraModel by camera name
+        self.choices = {} # (camera name, tag ID) to (tag rotation in camera, time)
+
+    def _camera(self, camera):
+        model = self.cameras.get(camera.name)
+        if model is None:
+            model = CameraModel(camera)
+            self.cameras[camera.name] = model
+        return model
+
+    def _candidates(self, pose_dict, size):
+        # Both poses of the tag in the camera in meters (2, 4, 4) and their
+        # reprojection errors in pixels, best first
+        model = self._camera(pose_dict['camera'])
+        points = model.normalize(pose_dict['detection'].corners)[_IPPE_ORDER]
+
+        count, rotations, translations, errors = cv2.solvePnPGeneric(
+            _IPPE_CORNERS * size, points, np.eye(3), None, flags=cv2.SOLVEPNP_IPPE_SQUARE)
+
+        poses = np.tile(np.eye(4), (2, 1, 1))
+        for i in range(count):
+            poses[i, :3, :3] = cv2.Rodrigues(rotations[i])[0]
+            poses[i, :3, 3] = translations[i].ravel()
+        errors = np.asarray(errors, dtype=np.float64).ravel() * model.focal.mean()
+
+        if count < 2:
+            poses[1] = poses[0]
+            errors = np.array([errors[0], np.inf])
+        return poses, errors
+
+    def _distance(self, robot_poses, pose):
+        # How far apart robot poses are, rotation counted as meters
+        return np.linalg.norm(robot_poses[..., :3, 3] - pose[:3, 3], axis=-1) \
+            + self.rotation_weight * _rotation_angles(robot_poses[..., :3, :3], pose[:3, :3])
+
+    def resolve(self, detections, tag_indices, camera_inverses, prior=None, timestamp=None):
+        # Returns the chosen pose of each tag in its camera in meters (N, 4, 4),
+        # its reprojection error in pixels and how each was chosen. prior is the last solved robot pose and
+        # when it was solved, as (pose, timestamp).
+        count = len(detections)
+        sizes = self.environment.sizes[tag_indices]
+
+        tag_poses = np.empty((count, 2, 4, 4))
+        errors = np.empty((count, 2))
+        for i, pose_dict in enumerate(detections):
+            tag_poses[i], errors[i] = self._candidates(pose_dict, sizes[i])
+
+        # Robot pose each candidate implies, (N, 2, 4, 4)
+        robot_poses = self.environment.transforms[tag_indices, None] @ invert_rigid(tag_poses) \
+            @ camera_inverses[:, None]
+
+        if prior is not None:
+            prior_pose, prior_time = prior
+            if timestamp is not None and prior_time is not None and timestamp - prior_time > self.prior_timeout:
+                prior = None
+
+        chosen = np.zeros(count, dtype=int)
+        reasons = []
+        for i, pose_dict in enumerate(detections):
+            key = (pose_dict['camera'].name, pose_dict['tag_id'])
+            remembered = self.choices.get(key)
+            if remembered is not None and timestamp is not None and timestamp - remembered[1] > self.choice_timeout:
+                remembered = None
+
+            if errors[i, 1] > self.error_ratio * errors[i, 0]:
+                reason = CHOICE_CLEAR
+            elif prior is not None:
+                chosen[i] = np.argmin(self._distance(robot_poses[i], prior_pose))
+                reason = CHOICE_PRIOR
+            elif count > 1:
+                # Sum over the other tags of how close their nearest pose is
+                others = np.delete(robot_poses, i, axis=0).reshape(-1, 4, 4)
+                costs = [np.sum(np.min(self._distance(others, candidate).reshape(count - 1, 2), axis=1))
+                         for candidate in robot_poses[i]]
+                chosen[i] = np.argmin(costs)
+                reason = CHOICE_TAGS
+            elif remembered is not None:
+                chosen[i] = np.argmin(_rotation_angles(tag_poses[i, :, :3, :3], remembered[0]))
+                reason = CHOICE_STICKY
+            else:
+                reason = CHOICE_ERROR
+
+            self.choices[key] = (tag_poses[i, chosen[i], :3, :3], timestamp)
+            reasons.append(reason)
+
+        picked = np.arange(count), chosen
+        return tag_poses[picked], errors[picked], reasons
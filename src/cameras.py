@@ -1,18 +1,22 @@
-from threading import Thread
+from threading import Thread, Condition
 import cv2
 import numpy as np
 import json
 from main import logger
 import time
+from undistortion import *
+from sources import open_source
 
 class Camera:
     def __init__(self, camera_options):
         # Extract indevidual values
-        camera_port = camera_options['port']
         self.name = camera_options['name']
         self.robot_position = camera_options['robot_pose']
         self.is_driver = camera_options.get('driver') is not None
 
+        # Native detector settings for just this camera, on top of detector.json
+        self.detector_options = camera_options.get('detector', {})
+
         # Extract params JSON
         try:
             location = f"camera_params/{camera_options['type']}.json"
@@ -29,14 +33,23 @@ class Camera:
         # Convert params to tuple
         self.camera_params = (params['fx'], params['fy'], params['cx'], params['cy'])
         self.distortion = params['dist']
+        self.dist_coeffs = np.array(self.distortion, dtype=np.float64).reshape(-1)
         self.matrix = np.array([
             self.camera_params[0], 0, self.camera_params[2],
             0, self.camera_params[1], self.camera_params[3],
             0, 0, 1
         ]).reshape(3, 3)
 
+        # Choose whether to undistort frames before they reach the detector
+        self.undistort_mode = camera_options.get('undistort', UNDISTORT_NONE)
+        if self.undistort_mode not in UNDISTORT_MODES:
+            logger.error(f"Unknown undistort mode '{self.undistort_mode}' for {self.name}")
+            raise ValueError(f"Undistort mode for {self.name} must be one of {UNDISTORT_MODES}")
+
+        self.undistorter = Undistorter(self.matrix, self.dist_coeffs)
 
-        self.capture = cv2.VideoCapture(camera_port)
+        # Physical camera, recording or in-memory frames
+        self.capture = open_source(camera_options, self)
 
     # def read(self, return_list=None, return_index=None):
     #     read_value = self.capture.read()
@@ -46,29 +59,84 @@ class Camera:
 
     #     return_list[return_index] = read_value
 
-    # Takes a queue, when reading the queue, you are reading the most up-to-date image
-    def start_reader(self, images_list, list_index):
-        while True:
+    # Keeps the slot filled with the most up-to-date image
+    def start_reader(self, slot):
+        failures = 0
+
+        while not slot.closed:
             ret, frame = self.capture.read() # Read the camera
+            timestamp = time.perf_counter()
+
+            if not ret and self.capture.finished:
+                logger.info(f"{self.name} has no more frames")
+                slot.finish()
+                break
 
             if not ret:
-                images_list[list_index] = ((ret, frame), self)
+                # Back off instead of spinning on a camera that isn't there
+                if failures % 100 == 0:
+                    logger.error(f"{self.name} failed to capture an image ({failures + 1} in a row)")
+                failures += 1
+                time.sleep(min(READ_RETRY_MAX_DELAY, READ_RETRY_DELAY * failures))
                 continue
+            failures = 0
 
-            height, width = frame.shape[:2]
-            dist_coeffs = np.array(self.distortion)
-            new_mtx, roi = cv2.getOptimalNewCameraMatrix(self.matrix, dist_coeffs, (width, height), 1, (width, height))
-
-            undistorted = cv2.undistort(frame, new_mtx, dist_coeffs, None, self.matrix)
-            crop_x, crop_y, crop_w, crop_h = roi
-            undistorted = undistorted[crop_y:crop_y + crop_h, crop_x:crop_x + crop_w]
+            # Remap tables are cached, so this only costs the remap itself
+            if self.undistort_mode == UNDISTORT_FULL:
+                frame = self.undistorter.undistort(frame)
 
-            images_list[list_index] = ((ret, frame), self)
+            # Recordings can wait for every frame to be processed
+            slot.put(frame, timestamp, self.capture.ground_truth, wait=self.capture.lossless)
 
     def release(self):
         self.capture.release()
 
 
+# Delay between attempts to read from a camera that failed to capture
+READ_RETRY_DELAY = 0.01
+READ_RETRY_MAX_DELAY = 0.5
+
+class FrameSlot: # Latest frame from one camera, numbered so it is only processed once
+    def __init__(self, camera, condition):
+        self.camera = camera
+        self.condition = condition
+
+        self.frame = None
+        self.timestamp = None
+        self.ground_truth = None # Robot pose when the frame was taken, if known
+        self.sequence = 0 # Increases by one for every captured frame
+        self.read_sequence = 0 # Sequence of the last frame handed out
+        self.closed = False
+        self.finished = False
+
+    def has_new_frame(self):
+        return self.sequence != self.read_sequence
+
+    def put(self, frame, timestamp, ground_truth=None, wait=False):
+        with self.condition:
+            # Don't replace a frame that hasn't been processed yet
+            if wait:
+                self.condition.wait_for(lambda: not self.has_new_frame() or self.closed)
+
+            self.frame = frame
+            self.timestamp = timestamp
+            self.ground_truth = ground_truth
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def take(self):
+        # Must be called with the condition held
+        skipped = self.sequence - self.read_sequence - 1
+        self.read_sequence = self.sequence
+        self.condition.notify_all()
+        return skipped
+
+    def finish(self):
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+
 class CameraArray:  # Multithread frame captures
     def __init__(self, logger, camera_list):
         # Put together a list of cameras
@@ -78,37 +146,54 @@ class CameraArray:  # Multithread frame captures
             logger.error("No cameras defined! Quitting")
             raise ValueError("No cameras defined in camera array!")
 
-        self.image_list = []
+        # Every camera writes its newest frame into its own slot
+        self.condition = Condition()
+        self.slots = [FrameSlot(camera, self.condition) for camera in self.camera_list]
         self.threads = []
 
         # Create threads for each camera
         for i, camera in enumerate(self.camera_list):
-            self.image_list.append(None) # Add something for the thread to edit
-            self.threads.append(Thread(target=camera.start_reader, args=(self.image_list, i,)))
+            self.threads.append(Thread(target=camera.start_reader, args=(self.slots[i],)))
             self.threads[i].start()
 
-    def read_cameras(self):  # Returns map of images to camera that they came from
-        final_images = []
+    def _has_new_frames(self):
+        return any(slot.has_new_frame() for slot in self.slots) or self.finished()
 
-        # Filter out failed image captures and log them
-        for read_image in self.image_list:
+    def lossless(self):
+        # True if any camera waits for each of its frames to be processed
+        return any(camera.capture.lossless for camera in self.camera_list)
 
-            if not read_image:
-                continue
+    def finished(self):
+        # True once every camera has run out of frames and all were read
+        return all(slot.finished and not slot.has_new_frame() for slot in self.slots)
 
-            image, camera = read_image
+    def wait_for_frames(self, timeout=None):
+        # Waits until any camera has a frame that hasn't been returned yet,
+        # then returns only those frames. Returns an empty list on timeout.
+        final_images = []
 
-            ret, frame = image  # Extract image into ret and the frame
+        with self.condition:
+            self.condition.wait_for(self._has_new_frames, timeout)
+
+            for slot in self.slots:
+                if not slot.has_new_frame():
+                    continue
 
-            if not ret:  # If the image couldn't be captured
-                logger.error(f"{camera.name} failed to capture an image")
-            else:  # Otherwise, remove the ret and leave just the image
                 final_images.append({
-                    'image': frame,  # Remove  ret
-                    'camera': camera
+                    'image': slot.frame,
+                    'camera': slot.camera,
+                    'sequence': slot.sequence,
+                    'timestamp': slot.timestamp,
+                    'ground_truth': slot.ground_truth,
+                    'skipped': slot.take() # Frames never processed
                 })
+
         return final_images
 
+    def read_cameras(self):  # Returns map of images to camera that they came from
+        # Only returns frames that haven't been read yet, without waiting
+        return self.wait_for_frames(timeout=0)
+
     def getParams(self):
         params = []
 
@@ -120,5 +205,13 @@ class CameraArray:  # Multithread frame captures
         return params
 
     def release_cameras(self):
+        # Stop the reader threads before releasing what they read from
+        with self.condition:
+            for slot in self.slots:
+                slot.closed = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
         for camera in self.camera_list:
             camera.release()
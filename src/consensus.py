@@ -0,0 +1,70 @@
+import numpy as np
+from rejections import REJECT_TRANSLATION, REJECT_ROTATION
+
+# Defaults for the 'consensus' section of solver.json
+DEFAULT_TRANSLATION_THRESHOLD = 1 # Meters a robot pose may be from the consensus
+DEFAULT_ROTATION_THRESHOLD = 30 # Degrees a robot pose may be from the consensus
+DEFAULT_MAX_HYPOTHESES = 32 # Poses tried as the consensus, the rest are only checked against them
+DEFAULT_PRIOR_TIMEOUT = 0.5 # Seconds the last solved pose still gets a vote
+
+def _rotation_angles(rotations, rotation):
+    # Angle in degrees between each of the stacked rotations and one rotation
+    cosines = (np.einsum('nij,ij->n', rotations, rotation) - 1) / 2
+    return np.degrees(np.arccos(np.clip(cosines, -1, 1)))
+
+
+class PoseConsensus:
+    # Finds the largest group of robot poses, one per tag, that agree with
+    # each other. Every pose is tried as the consensus (RANSAC with all
+    # hypotheses when there are few) and the one most poses agree with wins,
+    # with their weight breaking ties. The last solved pose gets a vote too,
+    # so one real tag can still beat one false one. A false decode almost
+    # never agrees with the real tags, so it ends up outside the group.
+    def __init__(self, options):
+        self.translation_threshold = options.get('translation_threshold', DEFAULT_TRANSLATION_THRESHOLD)
+        self.rotation_threshold = options.get('rotation_threshold', DEFAULT_ROTATION_THRESHOLD)
+        self.max_hypotheses = options.get('max_hypotheses', DEFAULT_MAX_HYPOTHESES)
+        self.prior_timeout = options.get('prior_timeout', DEFAULT_PRIOR_TIMEOUT)
+        self.random = np.random.default_rng()
+
+    def _agrees(self, distances, angles):
+        return (distances <= self.translation_threshold) & (angles <= self.rotation_threshold)
+
+    def select(self, robot_poses, weights, prior=None):
+        # Returns which poses are inliers and, for the others, why not as
+        # (index, reason, meters, degrees) from the consensus pose. prior is
+        # the last solved pose, if it is recent enough.
+        count = len(robot_poses)
+        if count < 2:
+            return np.ones(count, dtype=bool), []
+
+        hypotheses = np.arange(count)
+        if count > self.max_hypotheses:
+            hypotheses = self.random.choice(count, self.max_hypotheses, replace=False, p=weights / weights.sum())
+
+        positions = robot_poses[:, :3, 3]
+        rotations = robot_poses[:, :3, :3]
+
+        best_score = (0, 0)
+        for hypothesis in hypotheses:
+            distances = np.linalg.norm(positions - positions[hypothesis], axis=1)
+            angles = _rotation_angles(rotations, rotations[hypothesis])
+            inliers = self._agrees(distances, angles)
+            votes = np.count_nonzero(inliers)
+            if prior is not None:
+                votes += self._agrees(np.linalg.norm(prior[:3, 3] - positions[hypothesis]),
+                                      _rotation_angles(prior[None, :3, :3], rotations[hypothesis])[0])
+
+            # More tags agreeing beats fewer good ones
+            score = (votes, weights[inliers].sum())
+            if score > best_score:
+                best_score = score
+                best = (inliers, distances, angles)
+
+        inliers, distances, angles = best
+        rejections = []
+        for index in np.flatnonzero(~inliers):
+            reason = REJECT_TRANSLATION if distances[index] > self.translation_threshold else REJECT_ROTATION
+            rejections.append((index, reason, distances[index], angles[index]))
+
+        return inliers, rejections
@@ -0,0 +1,62 @@
+import numpy as np
+from rejections import *
+
+# Defaults for the 'filter' section of detector.json
+DEFAULT_MIN_DECISION_MARGIN = 30
+DEFAULT_MAX_HAMMING = 0 # tag16h5 has too few bits to trust corrected decodes
+DEFAULT_MIN_AREA = 100 # Square pixels at full resolution
+
+# Reasons a raw detection can be dropped here
+REJECT_REASONS = (REJECT_FAMILY, REJECT_UNKNOWN_TAG, REJECT_MARGIN, REJECT_HAMMING, REJECT_AREA)
+
+class DetectionFilter:
+    # Drops detections that are probably false positives straight after
+    # apriltag finds them, before any pose estimation, drawing or logging.
+    # Counts how many were dropped for each reason.
+    def __init__(self, options, tag_family=None, tag_ids=None):
+        self.min_decision_margin = options.get('min_decision_margin', DEFAULT_MIN_DECISION_MARGIN)
+        self.max_hamming = options.get('max_hamming', DEFAULT_MAX_HAMMING)
+        self.min_area = options.get('min_area', DEFAULT_MIN_AREA)
+
+        # apriltag reports the family as bytes
+        self.tag_family = tag_family.encode() if tag_family is not None else None
+
+        # IDs in the environment, as a lookup table indexed by ID
+        self.known_ids = None
+        if tag_ids is not None and options.get('environment_ids', True):
+            tag_ids = np.asarray(tag_ids, dtype=np.int64)
+            self.known_ids = np.zeros(tag_ids.max() + 1 if len(tag_ids) else 0, dtype=bool)
+            self.known_ids[tag_ids] = True
+
+        self.rejected = dict.fromkeys(REJECT_REASONS, 0)
+
+    def _reason(self, result, area_scale):
+        # Cheapest checks first
+        if result.hamming > self.max_hamming:
+            return REJECT_HAMMING
+        if result.decision_margin < self.min_decision_margin:
+            return REJECT_MARGIN
+        if self.known_ids is not None and not (0 <= result.tag_id < len(self.known_ids) and self.known_ids[result.tag_id]):
+            return REJECT_UNKNOWN_TAG
+        if self.tag_family is not None and self.tag_family not in result.tag_family:
+            return REJECT_FAMILY
+
+        x, y = result.corners[:, 0], result.corners[:, 1]
+        area = 0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+        if area * area_scale < self.min_area:
+            return REJECT_AREA
+
+        return None
+
+    def apply(self, results, scale=1):
+        # Keeps the detections that pass, scale is how much smaller the
+        # image they were found in is than the full frame
+        kept = []
+        area_scale = 1 / scale ** 2
+        for result in results:
+            reason = self._reason(result, area_scale)
+            if reason is None:
+                kept.append(result)
+            else:
+                self.rejected[reason] += 1
+        return kept
@@ -0,0 +1,288 @@
+import multiprocessing as mp
+import queue
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from main import logger
+from gui import draw_bounding_box
+
+# Imported as a module, since running main.py as a script imports this while
+# tag_tracker is still half loaded
+import tag_tracker
+
+# Frames each camera can have in flight before new ones are dropped
+RING_SLOTS = 3
+
+# Seconds to wait for a worker before giving up on its frame
+RESULT_TIMEOUT = 1.0
+
+# Times a camera's worker is restarted after dying before the camera is
+# left out of detection
+MAX_WORKER_RESTARTS = 3
+
+class _CameraSpec: # What a worker needs to know about a camera, without its capture
+    def __init__(self, camera):
+        self.name = camera.name
+        self.camera_params = camera.camera_params
+        self.matrix = camera.matrix
+        self.dist_coeffs = camera.dist_coeffs
+        self.undistort_mode = camera.undistort_mode
+        self.detector_options = camera.detector_options
+
+
+class _FrameRing: # Shared memory slots that frames are copied into for a worker
+    def __init__(self, slots):
+        self.slot_count = slots
+        self.memory = None
+        self.shape = None
+        self.dtype = None
+        self.frame_bytes = 0
+        self.free = []
+
+    def _allocate(self, shape, dtype):
+        # Only happens on the first frame and when the resolution changes
+        self.release()
+
+        self.frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.memory = shared_memory.SharedMemory(create=True, size=self.frame_bytes * self.slot_count)
+        self.shape = shape
+        self.dtype = dtype
+        self.free = list(range(self.slot_count))
+
+    def slot_array(self, slot):
+        return np.ndarray(self.shape, self.dtype, buffer=self.memory.buf, offset=slot * self.frame_bytes)
+
+    def put(self, frame):
+        # Copies a frame into a free slot, returns None if all are in use
+        if frame.shape != self.shape or frame.dtype != self.dtype:
+            if len(self.free) != self.slot_count and self.memory is not None:
+                return None # Wait for the old frames to finish first
+            self._allocate(frame.shape, frame.dtype)
+
+        if not self.free:
+            return None
+
+        slot = self.free.pop()
+        np.copyto(self.slot_array(slot), frame)
+        return slot
+
+    def release_slot(self, slot):
+        self.free.append(slot)
+
+    def release_all(self):
+        # For when the worker using the slots is gone
+        self.free = list(range(self.slot_count))
+
+    def release(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+
+def _attach_memory(name):
+    # Attaching must not register the memory with the resource tracker,
+    # otherwise it gets unlinked when the worker exits
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError: # Python before 3.13
+        # Workers share the main process's tracker, started before them,
+        # where the memory is already registered. Registering again does
+        # nothing, unregistering would drop the main process's entry.
+        return shared_memory.SharedMemory(name=name)
+
+def _detection_worker(options, tag_family, tag_ids, camera, tasks, results):
+    # Runs in its own process with its own native detector
+    detector = tag_tracker.Detector(None, options, draw=False, tag_family=tag_family, tag_ids=tag_ids)
+    memory = None
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        camera_index, memory_name, slot, shape, dtype, sequence = task
+
+        # Attach again whenever the main process made a new ring
+        if memory is None or memory.name != memory_name:
+            if memory is not None:
+                memory.close()
+            memory = _attach_memory(memory_name)
+
+        frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        image = np.ndarray(shape, dtype, buffer=memory.buf, offset=slot * frame_bytes)
+
+        estimated_poses = detector.detect(image, camera)
+        del image
+
+        # Only the small results go back, the camera is attached again there
+        for estimated_pose in estimated_poses:
+            del estimated_pose['camera']
+
+        results.put((camera_index, slot, sequence, estimated_poses, detector.status()))
+
+    if memory is not None:
+        memory.close()
+
+
+class DetectionEngine:
+    # Runs detection for each camera in its own worker process. Frames are
+    # passed through shared memory and only the detections come back, so
+    # cameras are processed in parallel on separate cores.
+    def __init__(self, logger, options, camera_list, draw=True, slots=RING_SLOTS, tag_family=None, tag_ids=None):
+        self.camera_list = camera_list
+        self.draw = draw
+        self.options = options
+        self.tag_family = tag_family
+        self.tag_ids = tag_ids
+
+        self.results = mp.Queue()
+        self.tasks = [None] * len(camera_list)
+        self.rings = [_FrameRing(slots) for _ in camera_list]
+        self.workers = [None] * len(camera_list)
+        self.restarts = [0] * len(camera_list)
+        self.in_flight = 0
+        self.dropped = 0
+
+        # Workers started before the resource tracker each get their own,
+        # which unlinks the frames when they die
+        resource_tracker.ensure_running()
+        for camera_index in range(len(camera_list)):
+            self._start_worker(camera_index)
+
+        logger.info(f"Started {len(self.workers)} detection worker processes")
+
+        # Images that are waiting on results, by camera and sequence
+        self.pending = {}
+
+        # Latest status reported by each worker's detector
+        self.camera_status = {}
+
+    def _start_worker(self, camera_index):
+        # A fresh task queue, so nothing meant for a dead worker is left in it
+        tasks = mp.Queue()
+        worker = mp.Process(target=_detection_worker,
+                            args=(self.options, self.tag_family, self.tag_ids,
+                                  _CameraSpec(self.camera_list[camera_index]), tasks, self.results),
+                            name=f"Detector {self.camera_list[camera_index].name}", daemon=True)
+        worker.start()
+
+        self.tasks[camera_index] = tasks
+        self.workers[camera_index] = worker
+
+    def _check_workers(self):
+        # Gives up on the frames of workers that died, then restarts them or
+        # leaves their camera out once they have died too often
+        for camera_index, worker in enumerate(self.workers):
+            if worker is None or worker.is_alive():
+                continue
+
+            name = self.camera_list[camera_index].name
+            lost = [key for key in self.pending if key[0] == camera_index]
+            for key in lost:
+                del self.pending[key]
+            self.in_flight -= len(lost)
+            self.rings[camera_index].release_all()
+
+            if self.restarts[camera_index] < MAX_WORKER_RESTARTS:
+                self.restarts[camera_index] += 1
+                logger.error(f"Detection worker for {name} died (exit code {worker.exitcode}), "
+                             f"lost {len(lost)} frames, restarting it ({self.restarts[camera_index]} of {MAX_WORKER_RESTARTS})")
+                self._start_worker(camera_index)
+            else:
+                logger.error(f"Detection worker for {name} died (exit code {worker.exitcode}) "
+                             f"{MAX_WORKER_RESTARTS + 1} times, no longer detecting tags on it")
+                self.workers[camera_index] = None
+                self.tasks[camera_index] = None
+
+    def submit(self, images):
+        # Hands frames to the workers without waiting for them
+        for image_dict in images:
+            camera_index = self.camera_list.index(image_dict['camera'])
+            if self.workers[camera_index] is None:
+                continue # Its worker kept dying
+            ring = self.rings[camera_index]
+
+            slot = ring.put(image_dict['image'])
+            if slot is None:
+                # The worker is behind, skip this frame rather than queue it
+                self.dropped += 1
+                continue
+
+            sequence = image_dict.get('sequence', 0)
+            self.pending[(camera_index, sequence)] = image_dict
+            self.tasks[camera_index].put((camera_index, ring.memory.name, slot,
+                                          ring.shape, ring.dtype.str, sequence))
+            self.in_flight += 1
+
+    def collect(self, timeout=RESULT_TIMEOUT, wait_all=True):
+        # Returns the poses of finished frames, waiting for every frame in
+        # flight if wait_all is set
+        estimated_poses = []
+
+        while self.in_flight:
+            try:
+                if wait_all:
+                    result = self.results.get(timeout=timeout)
+                else:
+                    result = self.results.get_nowait()
+            except queue.Empty:
+                # A dead worker's frames never come back, so stop waiting
+                # on them instead of timing out on every frame
+                in_flight = self.in_flight
+                self._check_workers()
+                if self.in_flight != in_flight and wait_all:
+                    continue # Wait for the workers that are still alive
+
+                if wait_all:
+                    logger.error(f"Detection workers didn't answer within {timeout} s")
+                break
+
+            camera_index, slot, sequence, poses, status = result
+            self.camera_status.update(status)
+
+            image_dict = self.pending.pop((camera_index, sequence), None)
+            if image_dict is None:
+                continue # Its worker died and its slots were already freed
+
+            self.rings[camera_index].release_slot(slot)
+            self.in_flight -= 1
+            camera = image_dict['camera']
+
+            for estimated_pose in poses:
+                estimated_pose['camera'] = camera
+
+                if self.draw:
+                    draw_bounding_box(image_dict['image'], estimated_pose['detection'],
+                                      camera.camera_params, estimated_pose['pose'])
+
+            estimated_poses.extend(poses)
+
+        return estimated_poses
+
+    def getPoses(self, images):
+        # Same as Detector.getPoses, but all cameras are detected at once
+        self.submit(images)
+        estimated_poses = self.collect()
+
+        if estimated_poses:
+            logger.debug(f"Estimated pose on {len(estimated_poses)} AprilTags")
+
+        return estimated_poses
+
+    def status(self):
+        # Detection latency and profile per camera, for reporting
+        return self.camera_status
+
+    def shutdown(self):
+        for tasks in self.tasks:
+            if tasks is not None:
+                tasks.put(None)
+        for worker in self.workers:
+            if worker is None:
+                continue
+            worker.join(timeout=RESULT_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+
+        for ring in self.rings:
+            ring.release()
@@ -0,0 +1,90 @@
+import json
+import numpy as np
+
+# Corners of a tag of size 1 in the tag's frame, in the order apriltag
+# reports them (X right, Y down, Z into the tag)
+UNIT_TAG_CORNERS = np.array([
+    [-0.5, -0.5, 0],
+    [ 0.5, -0.5, 0],
+    [ 0.5,  0.5, 0],
+    [-0.5,  0.5, 0]
+], dtype=np.float64)
+
+# How far a tag's rotation may be from a real rotation before it's rejected
+_ROTATION_TOLERANCE = 1e-3
+
+def invert_rigid(m):
+    # Inverts stacked rigid transforms (rotation and translation only), shape (..., 4, 4)
+    rotation = np.swapaxes(m[..., :3, :3], -1, -2)
+    inverse = np.zeros_like(m)
+    inverse[..., :3, :3] = rotation
+    inverse[..., :3, 3] = -np.einsum('...ij,...j->...i', rotation, m[..., :3, 3])
+    inverse[..., 3, 3] = 1
+    return inverse
+
+def _tag_transform(tag):
+    # environment.json has flat lists of 16 and nested 4x4 lists
+    transform = np.array(tag['transform'], dtype=np.float64)
+    if transform.size != 16:
+        raise ValueError(f"Tag {tag['id']} transform must have 16 values, not {transform.size}")
+    transform = transform.reshape(4, 4)
+
+    if not np.all(np.isfinite(transform)):
+        raise ValueError(f"Tag {tag['id']} transform isn't finite")
+    if not np.allclose(transform[3], [0, 0, 0, 1]):
+        raise ValueError(f"Tag {tag['id']} transform must end in a row of 0, 0, 0, 1")
+
+    rotation = transform[:3, :3]
+    if not np.allclose(rotation.T @ rotation, np.eye(3), atol=_ROTATION_TOLERANCE) \
+            or np.linalg.det(rotation) < 0:
+        raise ValueError(f"Tag {tag['id']} transform isn't a rotation and translation")
+
+    return transform
+
+
+class Environment:
+    # Tags of environment.json checked once and stored as arrays. Rows are in
+    # the order of the JSON, row_of[tag_id] finds a tag's row (-1 if unknown).
+    def __init__(self, environment_dict):
+        tags = environment_dict.get('tags')
+        if not tags:
+            raise AssertionError('No tags defined in environment JSON')
+        self.tag_family = environment_dict['tag_family']
+
+        ids = []
+        for tag in tags:
+            tag_id = tag.get('id')
+            if not isinstance(tag_id, int) or tag_id < 0:
+                raise ValueError(f"Tag IDs must be whole numbers of at least 0, not '{tag_id}'")
+            if tag_id in ids:
+                raise ValueError(f"Tag {tag_id} is defined more than once")
+            if not tag.get('size', 0) > 0:
+                raise ValueError(f"Tag {tag_id} needs a size above 0")
+            ids.append(tag_id)
+
+        self.ids = np.array(ids, dtype=np.int64)
+        self.sizes = np.array([tag['size'] for tag in tags], dtype=np.float64)
+        self.transforms = np.array([_tag_transform(tag) for tag in tags], dtype=np.float64)
+        self.inverses = invert_rigid(self.transforms)
+
+        # Where each tag's corners are on the field, shape (tags, 4, 3)
+        local_corners = UNIT_TAG_CORNERS[None] * self.sizes[:, None, None]
+        self.corners = np.einsum('tij,tkj->tki', self.transforms[:, :3, :3], local_corners) \
+            + self.transforms[:, None, :3, 3]
+
+        self.row_of = np.full(self.ids.max() + 1, -1, dtype=np.int64)
+        self.row_of[self.ids] = np.arange(len(ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, tag_id):
+        # Row of a tag in the arrays, or -1 if it isn't in the environment
+        if 0 <= tag_id < len(self.row_of):
+            return self.row_of[tag_id]
+        return -1
+
+
+def load_environment(path):
+    with open(path, 'r') as environment_json:
+        return Environment(json.load(environment_json))
@@ -0,0 +1,95 @@
+import numpy as np
+from quaternions import *
+
+# Defaults for the 'fusion' section of solver.json
+DEFAULT_TRANSLATION_SIGMA = 0.02 # Meters of error of one good tag at the reference distance
+DEFAULT_ROTATION_SIGMA = 0.02 # Radians of error of one good tag at the reference distance
+DEFAULT_REFERENCE_DISTANCE = 2 # Meters
+DEFAULT_ERROR_SCALE = 0.1 # Pose error from apriltag that doubles the uncertainty
+DEFAULT_PIXEL_ERROR_SCALE = 1 # Reprojection error in pixels that doubles the uncertainty
+DEFAULT_MARGIN_REFERENCE = 50 # Decision margin of a clean decode
+DEFAULT_MIN_VIEW_COSINE = 0.2 # Tags seen more edge on than this count as this
+DEFAULT_MIN_VIEW_SINE = 0.1 # Tags seen more head on than this count as this
+
+# apriltag reports a huge error when its pose refinement fails
+_MAX_ERROR = 1
+
+class PoseFusion:
+    # Combines the robot poses from every tag seen in a frame into one 6-DoF
+    # pose. Each estimate gets an uncertainty from how far away its tag was
+    # and at what angle, apriltag's pose error and the decision margin, and is
+    # weighted by the inverse of its variance. Rotations are averaged with
+    # the quaternion mean of Markley et al.
+    def __init__(self, options):
+        self.translation_sigma = options.get('translation_sigma', DEFAULT_TRANSLATION_SIGMA)
+        self.rotation_sigma = options.get('rotation_sigma', DEFAULT_ROTATION_SIGMA)
+        self.reference_distance = options.get('reference_distance', DEFAULT_REFERENCE_DISTANCE)
+        self.error_scale = options.get('error_scale', DEFAULT_ERROR_SCALE)
+        self.pixel_error_scale = options.get('pixel_error_scale', DEFAULT_PIXEL_ERROR_SCALE)
+        self.margin_reference = options.get('margin_reference', DEFAULT_MARGIN_REFERENCE)
+        self.min_view_cosine = options.get('min_view_cosine', DEFAULT_MIN_VIEW_COSINE)
+        self.min_view_sine = options.get('min_view_sine', DEFAULT_MIN_VIEW_SINE)
+
+    def uncertainty(self, tag_poses, errors, margins, pixels=False):
+        # How many times worse than one good tag at the reference distance
+        # each estimate is. tag_poses are the tags in camera space, scaled
+        # to meters, shape (N, 4, 4).
+        translations = tag_poses[:, :3, 3]
+        distances = np.linalg.norm(translations, axis=1)
+
+        # Seen edge on, the corners are hard to place. Seen head on, the
+        # tag's tilt is ambiguous, which moves the robot sideways by up to
+        # the distance times the tilt error.
+        view_cosines = np.abs(np.einsum('ni,ni->n', tag_poses[:, :3, 2], translations)) / distances
+        view_sines = np.sqrt(np.clip(1 - view_cosines ** 2, 0, 1))
+        view = np.hypot(1 / np.maximum(view_cosines, self.min_view_cosine),
+                        1 / np.maximum(view_sines, self.min_view_sine))
+
+        # Errors are apriltag's pose error, or reprojection errors in pixels
+        # when the pose was picked by the ambiguity resolver
+        if pixels:
+            errors = errors / self.pixel_error_scale
+        else:
+            errors = np.minimum(errors, _MAX_ERROR) / self.error_scale
+
+        return distances / self.reference_distance \
+            * (1 + errors) \
+            * self.margin_reference / np.clip(margins, 1, self.margin_reference) \
+            * view
+
+    def fuse(self, robot_poses, scales):
+        # Returns a dict with the fused pose, its position and (w, x, y, z)
+        # rotation, and the 6x6 covariance of position and rotation vector
+
+        # Relative to the best estimate so huge scales can't all round to 0
+        weights = (scales.min() / scales) ** 2
+        weights = weights / weights.sum()
+
+        position = weights @ robot_poses[:, :3, 3]
+
+        quaternions = matricesToQuats(robot_poses)
+        rotation = averageQuats(quaternions, weights)
+
+        pose = np.eye(4)
+        pose[:3, :3] = quatsToMatrices(rotation)
+        pose[:3, 3] = position
+
+        # How sure the estimates say they are together...
+        variance = 1 / np.sum(1 / scales ** 2)
+        covariance = np.diag([self.translation_sigma ** 2] * 3 + [self.rotation_sigma ** 2] * 3) * variance
+
+        # ...plus how much they actually disagree
+        if len(robot_poses) > 1:
+            relative = multiplyQuats(invertQuats(rotation), quaternions)
+            residuals = np.concatenate([robot_poses[:, :3, 3] - position, quatsToRotationVectors(relative)], axis=1)
+
+            effective_count = 1 / np.sum(weights ** 2)
+            covariance += np.einsum('n,ni,nj->ij', weights, residuals, residuals) / effective_count
+
+        return {
+            'pose': pose,
+            'position': position,
+            'rotation': rotation,
+            'covariance': covariance,
+            'samples': len(robot_poses)
+        }
@@ -0,0 +1,217 @@
+import cv2
+import numpy as np
+from environment import invert_rigid
+from quaternions import *
+from undistortion import UNDISTORT_FULL
+
+# Defaults for the 'joint' section of solver.json
+DEFAULT_ITERATIONS = 10
+DEFAULT_HUBER_PIXELS = 2 # Corners further off than this count less
+DEFAULT_SEED_TIMEOUT = 0.5 # Seconds the last solution is still a good starting point
+DEFAULT_MAX_ERROR_PIXELS = 8 # RMS reprojection error above which a solve is thrown out
+
+# apriltag places corners half a pixel further along x and y than OpenCV's
+# camera model, which puts pixel centers on whole numbers
+CORNER_OFFSET = 0.5
+
+_CONVERGED = 1e-8 # Step size (meters and radians) small enough to stop
+
+def _exp(vector):
+    return cv2.Rodrigues(np.asarray(vector, dtype=np.float64).reshape(3, 1))[0]
+
+def _skew(vectors):
+    # Cross product matrices of stacked vectors, shape (..., 3, 3)
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+    zero = np.zeros_like(x)
+    return np.stack([
+        np.stack([zero, -z, y], axis=-1),
+        np.stack([z, zero, -x], axis=-1),
+        np.stack([-y, x, zero], axis=-1)
+    ], axis=-2)
+
+
+class CameraModel: # What the solver needs from a camera, converted once
+    def __init__(self, camera):
+        self.matrix = np.array(camera.matrix, dtype=np.float64)
+        self.focal = self.matrix[[0, 1], [0, 1]]
+
+        # Full undistortion already removed the lens distortion from the frame
+        self.distortion = np.array(camera.dist_coeffs, dtype=np.float64)
+        if camera.undistort_mode == UNDISTORT_FULL:
+            self.distortion = np.zeros(0)
+
+        robot_to_camera = np.array(camera.robot_position, dtype=np.float64).reshape(4, 4)
+        self.robot_to_camera = robot_to_camera
+        self.camera_from_robot = invert_rigid(robot_to_camera)
+
+    def normalize(self, corners):
+        # Pixel corners to undistorted points on the z = 1 plane, shape (N, 2)
+        corners = np.asarray(corners, dtype=np.float64).reshape(-1, 1, 2) - CORNER_OFFSET
+        if self.distortion.size and np.any(self.distortion):
+            return cv2.undistortPoints(corners, self.matrix, self.distortion).reshape(-1, 2)
+        return (corners.reshape(-1, 2) - self.matrix[:2, 2]) / self.focal
+
+
+class JointPoseSolver:
+    # Solves for the one robot pose that best explains every tag corner seen
+    # by every camera, with Levenberg-Marquardt on the reprojection error in
+    # pixels. Unlike solving each tag on its own, tags constrain each other,
+    # so there is no per-tag ambiguity once two or more are in view.
+    def __init__(self, environment, options):
+        self.environment = environment
+        self.iterations = options.get('iterations', DEFAULT_ITERATIONS)
+        self.huber_pixels = options.get('huber_pixels', DEFAULT_HUBER_PIXELS)
+        self.seed_timeout = options.get('seed_timeout', DEFAULT_SEED_TIMEOUT)
+        self.max_error_pixels = options.get('max_error_pixels', DEFAULT_MAX_ERROR_PIXELS)
+
+        self.cameras = {} # CameraModel by camera name
+        self.last_pose = None
+        self.last_time = None
+
+    def _camera(self, camera):
+        model = self.cameras.get(camera.name)
+        if model is None:
+            model = CameraModel(camera)
+            self.cameras[camera.name] = model
+        return model
+
+    def _observations(self, detections, tag_indices):
+        # Stacks every corner of every detection: field points, where they
+        # were seen on the z = 1 plane, the camera's pose on the robot and
+        # its focal length
+        points, observed, transforms, focals = [], [], [], []
+        for detection, index in zip(detections, tag_indices):
+            model = self._camera(detection['camera'])
+            points.append(self.environment.corners[index])
+            observed.append(model.normalize(detection['detection'].corners))
+            transforms.append(np.broadcast_to(model.camera_from_robot, (4, 4, 4)))
+            focals.append(np.broadcast_to(model.focal, (4, 2)))
+
+        return np.concatenate(points), np.concatenate(observed), \
+            np.concatenate(transforms), np.concatenate(focals)
+
+    @staticmethod
+    def _residuals(pose, points, observed, transforms, focals):
+        # Reprojection error in pixels (M, 2) and the points in the robot's
+        # and cameras' frames
+        robot_points = (points - pose[:3, 3]) @ pose[:3, :3]
+        camera_points = np.einsum('mij,mj->mi', transforms[:, :3, :3], robot_points) + transforms[:, :3, 3]
+        projected = camera_points[:, :2] / camera_points[:, 2:]
+        return (projected - observed) * focals, robot_points, camera_points
+
+    def _cost(self, pose, observations):
+        residuals, _, camera_points = self._residuals(pose, *observations)
+        if np.any(camera_points[:, 2] <= 0):
+            return np.inf # Corners behind a camera can't have been seen
+        return np.sum(self._huber(np.sum(residuals ** 2, axis=1)))
+
+    def _huber(self, squared):
+        # Huber loss of squared distances
+        distances = np.sqrt(squared)
+        return np.where(distances <= self.huber_pixels, squared,
+                        2 * self.huber_pixels * distances - self.huber_pixels ** 2)
+
+    def _jacobian(self, pose, robot_points, camera_points, transforms, focals):
+        # Derivative of each residual with respect to a change of the robot's
+        # position (in the field) and rotation (in the robot's frame), (M, 2, 6)
+        x, y, z = camera_points[:, 0], camera_points[:, 1], camera_points[:, 2]
+        zero = np.zeros_like(z)
+        projection = np.stack([
+            np.stack([1 / z, zero, -x / z ** 2], axis=-1),
+            np.stack([zero, 1 / z, -y / z ** 2], axis=-1)
+        ], axis=-2) * focals[:, :, None]
+
+        robot_jacobian = np.concatenate([
+            np.broadcast_to(-pose[:3, :3].T, (len(z), 3, 3)),
+            _skew(robot_points)
+        ], axis=2)
+
+        return projection @ transforms[:, :3, :3] @ robot_jacobian
+
+    def _refine(self, pose, observations):
+        # Levenberg-Marquardt from the given pose, returns the pose and the
+        # normal matrix at the solution
+        points, observed, transforms, focals = observations
+        damping = 1e-3
+        cost = self._cost(pose, observations)
+        normal = None
+
+        for _ in range(self.iterations):
+            residuals, robot_points, camera_points = self._residuals(pose, *observations)
+            jacobian = self._jacobian(pose, robot_points, camera_points, transforms, focals)
+
+            # Reweight so far off corners act like Huber loss
+            distances = np.linalg.norm(residuals, axis=1)
+            weights = np.where(distances <= self.huber_pixels, 1, self.huber_pixels / np.maximum(distances, 1e-12))
+
+            normal = np.einsum('m,mki,mkj->ij', weights, jacobian, jacobian)
+            gradient = np.einsum('m,mki,mk->i', weights, jacobian, residuals)
+
+            while True:
+                step = -np.linalg.solve(normal + damping * np.diag(np.diag(normal) + 1e-9), gradient)
+                candidate = pose.copy()
+                candidate[:3, 3] += step[:3]
+                candidate[:3, :3] = pose[:3, :3] @ _exp(step[3:])
+
+                candidate_cost = self._cost(candidate, observations)
+                if candidate_cost <= cost:
+                    pose, cost = candidate, candidate_cost
+                    damping = max(damping / 10, 1e-9)
+                    break
+
+                damping *= 10
+                if damping > 1e6:
+                    return pose, normal, cost
+
+            if np.linalg.norm(step) < _CONVERGED:
+                break
+
+        return pose, normal, cost
+
+    def solve(self, detections, tag_indices, seeds, timestamp=None):
+        # detections are the detector's pose dicts, seeds are robot poses
+        # from single tags (N, 4, 4). Returns a dict like PoseFusion.fuse,
+        # or None if there was nothing to solve.
+        if not detections:
+            return None
+
+        observations = self._observations(detections, tag_indices)
+
+        # Start from whichever guess explains the corners best, the last
+        # solution usually wins unless the robot was moved or lost track
+        candidates = list(seeds)
+        if self.last_pose is not None and (timestamp is None or self.last_time is None
+                                           or timestamp - self.last_time <= self.seed_timeout):
+            candidates.append(self.last_pose)
+        if not candidates:
+            return None
+
+        costs = [self._cost(candidate, observations) for candidate in candidates]
+        best = int(np.argmin(costs))
+        if not np.isfinite(costs[best]):
+            return None
+
+        pose, normal, cost = self._refine(candidates[best].copy(), observations)
+
+        # Robust estimate of the corner noise from what is left over
+        corner_count = len(observations[0])
+        error = np.sqrt(cost / corner_count)
+        if error > self.max_error_pixels:
+            return None
+
+        # Covariance of position and rotation vector from the normal
+        # matrix, scaled by the noise per residual
+        degrees_of_freedom = max(2 * corner_count - 6, 1)
+        covariance = np.linalg.pinv(normal) * cost / degrees_of_freedom
+
+        self.last_pose = pose
+        self.last_time = timestamp
+
+        return {
+            'pose': pose,
+            'position': pose[:3, 3].copy(),
+            'rotation': np.array(matrixToQuat(pose[:3, :3])),
+            'covariance': covariance,
+            'samples': len(detections),
+            'reprojection_error': error
+        }
@@ -21,11 +21,21 @@ logger = logging.getLogger()
 
 from argparse import ArgumentParser
 from tag_tracker import *
+from detection_workers import DetectionEngine
+from pipeline import *
 from solver import *
+from pose_filter import *
+from environment import Environment
 from shufflelog_api import ShuffleLogAPI
 from driver_station import get_driver_frame
 import json
 
+# Seconds to wait for a new camera frame before servicing messages anyway
+FRAME_TIMEOUT = 0.1
+
+# Seconds between frame rate reports
+FPS_REPORT_INTERVAL = 1
+
 def main():
     # Create a parser to allow variable arguments
     parser = ArgumentParser(prog='AprilTag tracker',
@@ -34,7 +44,11 @@ def main():
     parser.add_argument('-e', '--environment', type=str, default='environment.json', metavar='', help='Path to environment definition JSON')
     parser.add_argument('-c', '--cameras', type=str, default='cameras.json', metavar='', help='Path to camera definition JSON')
     parser.add_argument('-d', '--detector', type=str, default='detector.json', metavar='', help='Path to detector definition JSON')
+    parser.add_argument('-s', '--solver', type=str, default='solver.json', metavar='', help='Path to solver definition JSON')
     parser.add_argument('-n', '--no_gui',  action='store_true', help='Hide OpenCV gui.')
+    parser.add_argument('-p', '--processes', action='store_true', help='Detect tags in one worker process per camera.')
+    parser.add_argument('-b', '--backpressure', type=str, default=None, choices=BACKPRESSURE_POLICIES, help='What a full queue between pipeline stages does, block for lossless recordings and drop_oldest otherwise by default.')
+    parser.add_argument('-q', '--queue_size', type=int, default=2, metavar='', help='Number of items each queue between pipeline stages holds.')
 
     args = parser.parse_args()
 
@@ -59,6 +73,13 @@ def main():
 
     environment_json.close()
 
+    # Check the tags once and turn them into arrays everything shares
+    try:
+        environment = Environment(environment)
+    except (AssertionError, KeyError, ValueError):
+        logger.exception("Environment JSON is invalid, quitting")
+        raise
+
     # Exctract cameras JSON
     try:
         cameras_json = open(args.cameras, 'r')
@@ -83,17 +104,46 @@ def main():
 
     detector_json.close()
 
-    # Setup a detector with the JSON settings
-    detector = Detector(logger, detector)
+    # Extract solver JSON
+    try:
+        solver_json = open(args.solver, 'r')
+        solver_options = json.load(solver_json)
+        logger.info("Solver JSON loaded")
+    except (FileNotFoundError, json.JSONDecodeError) as err:
+        logger.exception("Could not open solver JSON, qutting")
+        raise FileNotFoundError(f"Could not open solver JSON '{args.solver}', is the path relative to /TagTracker?") from err
+
+    solver_json.close()
 
     camera_list = [Camera(camera_info) for camera_info in cameras['cameras']]
 
+    # Setup a detector with the JSON settings, workers have to be
+    # started before the camera threads
+    if args.processes:
+        detector = DetectionEngine(logger, detector, camera_list, draw=not args.no_gui,
+                                   tag_family=environment.tag_family, tag_ids=environment.ids)
+    else:
+        detector = Detector(logger, detector, draw=not args.no_gui,
+                            tag_family=environment.tag_family, tag_ids=environment.ids)
+
     # Setup a camera array with the JSON settings
     camera_array = CameraArray(logger, camera_list)
 
     # Create a solver to filter estimated positions
     # and localize robot
-    solver = RobotPoseSolver(environment)
+    solver = RobotPoseSolver(environment, solver_options)
+
+    # Optionally smooth the pose over time and publish it at a fixed rate
+    filter_options = solver_options.get('filter', {})
+    pose_filter = PoseFilter(filter_options) if filter_options.get('enabled', False) else None
+
+    # With the filter, fusion solves each camera on its own so every
+    # measurement has its camera's timestamp, but then consensus only
+    # compares tags seen by the same camera. Joint solves need every
+    # camera's corners together, so they solve the whole frame at once.
+    solve_per_camera = pose_filter is not None and solver.mode != SOLVER_JOINT
+    if solve_per_camera and solver.consensus is not None and len(camera_list) > 1:
+        logger.info("Filter is on, so consensus only compares tags seen by the same camera")
 
     # Initialize ShuffleLog API
     messenger_params = {
@@ -102,25 +152,123 @@ def main():
         'name': 'TagTracker',
         'mute_errors': True
     }
-    api = ShuffleLogAPI(messenger_params, environment['tags'], cameras['cameras'])
+    api = ShuffleLogAPI(messenger_params, environment, cameras['cameras'])
+
 
+    # Count processed frames to report real detection rates, updated
+    # from the solve stage and reported from the main thread
+    stats = {'frames': 0, 'skipped': 0, 'rejected': 0, 'error_total': 0, 'error_count': 0}
+    fps_tic = time.perf_counter()
+
+    def capture():
+        # Only pass on frames that haven't been seen before
+        data = camera_array.wait_for_frames(timeout=FRAME_TIMEOUT)
+
+        # Stop once recorded footage has been played through
+        if not data and camera_array.finished():
+            logger.info("All cameras are out of frames, stopping")
+            return END
+
+        return data or None
+
+    def detect(data):
+        detection_poses = detector.getPoses(data)
+
+        # Report how long detection takes and which profile is in use
+        for name, status in detector.status().items():
+            table.putNumber(f"{name}/detection_latency_ms", status['latency_ms'])
+            table.putNumber(f"{name}/detector_profile", status['profile'])
+            for reason, count in status['rejected'].items():
+                table.putNumber(f"{name}/rejected_{reason}", count)
+
+        return data, detection_poses
+
+    def publish(estimate):
+        # Rotation is a (w, x, y, z) quaternion, covariance is 6x6 over
+        # position and rotation vector
+        if estimate is None:
+            table.putNumberArray('position', [0, 0, 0])
+        else:
+            table.putNumberArray('position', estimate['position'].tolist())
+            table.putNumberArray('rotation', estimate['rotation'].tolist())
+            table.putNumberArray('covariance', estimate['covariance'].ravel().tolist())
+
+    def solve(item):
+        data, detection_poses = item
+
+        if not solve_per_camera:
+            estimate, matrices = solver.solve(detection_poses, data[-1]['timestamp'])
+            stats['rejected'] += len(solver.rejections)
+
+            if pose_filter is None:
+                # Send the solved pose back to robot straight away, so nothing
+                # after this stage can delay it
+                publish(estimate)
+            else:
+                # The whole frame counts as one measurement at its latest time
+                if estimate is not None:
+                    pose_filter.update(data[-1]['timestamp'], estimate)
+                estimate = pose_filter.predict(data[-1]['timestamp'])
+        else:
+            # Each camera's frame is a measurement at the time it was taken
+            matrices = []
+            for image in data:
+                camera_poses = [pose for pose in detection_poses if pose['camera'] is image['camera']]
+                camera_estimate, camera_matrices = solver.solve(camera_poses, image['timestamp'])
+                matrices.extend(camera_matrices)
+                stats['rejected'] += len(solver.rejections)
+
+                if camera_estimate is not None:
+                    pose_filter.update(image['timestamp'], camera_estimate)
+
+            estimate = pose_filter.predict(data[-1]['timestamp'])
+
+        # Synthetic sources know where the robot really was
+        ground_truth = data[-1]['ground_truth']
+        if estimate is not None and ground_truth is not None:
+            stats['error_total'] += np.linalg.norm(estimate['position'] - ground_truth[:3, 3])
+            stats['error_count'] += 1
+
+        stats['frames'] += len(data)
+        stats['skipped'] += sum(image['skipped'] for image in data)
+
+        return data, matrices
+
+    # Each stage runs on its own thread with bounded queues in between. The
+    # GUI and ShuffleLog only ever get the latest result, so a slow
+    # connection can't hold up the pose sent to the robot.
+    backpressure = args.backpressure
+    if backpressure is None:
+        # Live cameras keep latency low, lossless recordings keep every
+        # frame all the way to the solver so replays are repeatable
+        backpressure = BACKPRESSURE_BLOCK if camera_array.lossless() else BACKPRESSURE_DROP_OLDEST
+    pipeline = Pipeline(args.queue_size, backpressure)
+    pipeline.add_stage('capture', capture)
+    pipeline.add_stage('detect', detect)
+    pipeline.add_stage('solve', solve, policy=BACKPRESSURE_DROP_OLDEST)
+    pipeline.start()
+
+    # The filter's poses go out at their own rate, not the cameras'
+    if pose_filter is not None:
+        publisher = PosePublisher(pose_filter, publish, filter_options.get('publish_rate', DEFAULT_PUBLISH_RATE))
+        publisher.start()
 
     # Main loop, run all the time like limelight
     while True:
-        tic = time.perf_counter();
-        data = camera_array.read_cameras()
-        detection_poses = detector.getPoses(data)
+        result = pipeline.get(timeout=FRAME_TIMEOUT)
+        if result is END:
+            break
 
-        position, matrices = solver.solve(detection_poses)
+        if result is not None:
+            data, matrices = result
 
-        if not args.no_gui:
-            for i, image in enumerate(data):
-                cv2.imshow(str(i), image['image'])
+            if not args.no_gui:
+                for image in data:
+                    cv2.imshow(image['camera'].name, image['image'])
 
-        # Send the solved position back to robot
-        api.publish_test_matrices(matrices)
-        if position is None: position = [0, 0, 0]
-        table.putNumberArray('position', position)
+            # Everything about one frame goes to ShuffleLog in one write
+            with api.batch():
+                api.publish_test_matrices(matrices)
 
         # Read incoming API messages
         api.read()
@@ -130,7 +278,24 @@ def main():
             break
 
         toc = time.perf_counter()
-        print(f"FPS: {1/(toc-tic)}")
+        if toc - fps_tic >= FPS_REPORT_INTERVAL:
+            report = f"FPS: {stats['frames'] / (toc - fps_tic):.1f} frames processed, {stats['skipped'] / (toc - fps_tic):.1f} skipped"
+            report += f", {stats['rejected']} tags rejected"
+            if stats['error_count']:
+                report += f", position error {stats['error_total'] / stats['error_count']:.3f} m"
+            report += f", dropped by stage {pipeline.dropped()}"
+            print(report)
+
+            # Totals since starting, like the detector's
+            for reason, count in solver.rejected.items():
+                table.putNumber(f"solver/rejected_{reason}", count)
+
+            stats.update(frames=0, skipped=0, rejected=0, error_total=0, error_count=0)
+            fps_tic = toc
+
+    pipeline.stop()
+    if pose_filter is not None:
+        publisher.stop()
 
     # Disconnect from Messenger
     api.shutdown()
@@ -138,6 +303,7 @@ def main():
     # Safely close video operation
     cv2.destroyAllWindows()
     camera_array.release_cameras()
+    detector.shutdown()
 
 
 if __name__ == '__main__':
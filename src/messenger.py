@@ -4,15 +4,36 @@ Python port of the MessengerClient API.
 Use MessengerClient to connect to a server. In order to properly
 receive messages, you must call the read_messages() method on it
 while your program is running. The disconnect() method should be
-called when the program ends to shut down background threads. If
-you do not call disconnect(), the program will appear to hang.
+called when the program ends, so queued messages are sent and the
+server is told the client is leaving.
 """
 
+import errno
+import selectors
+from contextlib import contextmanager
 import socket
 import time
 import threading
 import struct
-import select
+from collections import deque
+import numpy as np
+
+# Big endian element types of arrays, like Java's DataOutputStream
+_FLOAT_ARRAY = np.dtype('>f4')
+_DOUBLE_ARRAY = np.dtype('>f8')
+
+# Encodings of the fixed size fields, compiled once
+_BOOLEAN = struct.Struct('>?')
+_CHAR = struct.Struct('>H') # Java chars are two bytes
+_BYTE = struct.Struct('>b')
+_SHORT = struct.Struct('>h')
+_INT = struct.Struct('>i')
+_LONG = struct.Struct('>q')
+_FLOAT = struct.Struct('>f')
+_DOUBLE = struct.Struct('>d')
+
+# Bytes a new message has room for before it has to grow
+_INITIAL_CAPACITY = 256
 
 
 class MessageBuilder:
@@ -20,17 +41,52 @@ class MessageBuilder:
     Allows easy storage of data into a message.
     """
 
-    def __init__(self, client, type):
+    def __init__(self, client, type, capacity=_INITIAL_CAPACITY):
         self.client = client
         self.type = type
-        self.buffer = b''
-        pass
+
+        # Only the first size bytes are part of the message, the rest is
+        # room to grow into without reallocating on every field
+        self.buffer = bytearray(capacity)
+        self.size = 0
+
+    def _reserve(self, count):
+        # Makes room for count more bytes and returns where they start
+
+        start = self.size
+        end = start + count
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(end, 2 * len(self.buffer)) - len(self.buffer)))
+        self.size = end
+        return start
+
+    def _pack(self, encoding, value):
+        encoding.pack_into(self.buffer, self._reserve(encoding.size), value)
+        return self
+
+    def _pack_array(self, dtype, values):
+        # Writes an array straight into the buffer in the given big endian
+        # type, without packing each element on its own
+
+        values = np.asarray(values)
+        start = self._reserve(values.size * dtype.itemsize)
+        np.ndarray(values.shape, dtype, buffer=self.buffer, offset=start)[...] = values
+        return self
+
+    def get_data(self):
+        """
+        Gets the data added so far, without copying it.
+
+        :return: memoryview of the data
+        """
+
+        return memoryview(self.buffer)[:self.size]
 
     def send(self):
         """
         Sends the message with the type and data.
         """
-        self.client._send_message(self.type, self.buffer)
+        self.client._send_message(self.type, self.get_data())
 
     def add_boolean(self, b):
         """
@@ -40,8 +96,7 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += struct.pack('>?', b)
-        return self
+        return self._pack(_BOOLEAN, b)
 
     def add_string(self, s):
         """
@@ -51,8 +106,7 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += _encode_string(s)
-        return self
+        return self.add_raw(_encode_string(s))
 
     def add_char(self, c):
         """
@@ -62,8 +116,7 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += struct.pack('>c', c)
-        return self
+        return self._pack(_CHAR, ord(c))
 
     def add_byte(self, b):
         """
@@ -73,8 +126,7 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += struct.pack('>b', b)
-        return self
+        return self._pack(_BYTE, b)
 
     def add_short(self, s):
         """
@@ -84,8 +136,7 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += struct.pack('>s', s)
-        return self
+        return self._pack(_SHORT, s)
 
     def add_int(self, i):
         """
@@ -95,8 +146,7 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += struct.pack('>i', i)
-        return self
+        return self._pack(_INT, i)
 
     def add_long(self, l):
         """
@@ -106,8 +156,7 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += struct.pack('>q', l)
-        return self
+        return self._pack(_LONG, l)
 
     def add_float(self, f):
         """
@@ -117,8 +166,7 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += struct.pack('>f', f)
-        return self
+        return self._pack(_FLOAT, f)
 
     def add_double(self, d):
         """
@@ -128,8 +176,42 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += struct.pack('>d', d)
-        return self
+        return self._pack(_DOUBLE, d)
+
+    def add_float_array(self, a):
+        """
+        Adds every element of an array as a float, in row-major order.
+        No length is written.
+
+        :param a: array-like of numbers
+        :return: self
+        """
+
+        return self._pack_array(_FLOAT_ARRAY, a)
+
+    def add_double_array(self, a):
+        """
+        Adds every element of an array as a double, in row-major order.
+        No length is written.
+
+        :param a: array-like of numbers
+        :return: self
+        """
+
+        return self._pack_array(_DOUBLE_ARRAY, a)
+
+    def add_matrix4(self, m):
+        """
+        Adds one 4x4 matrix, or a stack of them with shape (N, 4, 4), as
+        floats in column-major order, which is how ShuffleLog reads them.
+        No count is written.
+
+        :param m: matrix or matrices to add
+        :return: self
+        """
+
+        m = np.asarray(m).reshape(-1, 4, 4)
+        return self._pack_array(_FLOAT_ARRAY, m.transpose(0, 2, 1))
 
     def add_raw(self, b):
         """
@@ -139,7 +221,8 @@ class MessageBuilder:
         :return: self
         """
 
-        self.buffer += b
+        start = self._reserve(len(b))
+        self.buffer[start:self.size] = b
         return self
 
 
@@ -151,17 +234,26 @@ class MessageReader:
     def __init__(self, data):
         """
         Creates a new MessageReader that reads from a raw byte array.
+        Received messages are a memoryview into a copy of the data, which
+        the handler may keep.
 
-        :param data: raw data
+        :param data: raw data, bytes or memoryview
         """
 
         self.data = data
         self.cursor = 0
 
+    def _unpack(self, encoding):
+        # Reads the next field straight from the data, without slicing it
+
+        value = encoding.unpack_from(self.data, self.cursor)[0]
+        self.cursor += encoding.size
+        return value
+
     def _next(self, count):
         # Reads the next count bytes from the data array as a bytes object
 
-        read = self.data[self.cursor:(self.cursor + count)]
+        read = bytes(self.data[self.cursor:(self.cursor + count)])
         self.cursor += count
         return read
 
@@ -172,7 +264,7 @@ class MessageReader:
         :return: boolean read
         """
 
-        return struct.unpack('?', self._next(1))[0]
+        return self._unpack(_BOOLEAN)
 
     def read_string(self):
         """
@@ -181,8 +273,10 @@ class MessageReader:
         :return: string read
         """
 
-        utf_len = struct.unpack('>H', self._next(2))[0]
-        return self._next(utf_len).decode('utf-8')
+        utf_len = self._unpack(_CHAR)
+        text = str(self.data[self.cursor:(self.cursor + utf_len)], 'utf-8')
+        self.cursor += utf_len
+        return text
 
     def read_char(self):
         """
@@ -191,7 +285,7 @@ class MessageReader:
         :return: character read
         """
 
-        return chr(struct.unpack('>H', self._next(2)))[0]
+        return chr(self._unpack(_CHAR))
 
     def read_byte(self):
         """
@@ -200,7 +294,7 @@ class MessageReader:
         :return: byte read
         """
 
-        return struct.unpack('b', self._next(1))[0]
+        return self._unpack(_BYTE)
 
     def read_short(self):
         """
@@ -209,7 +303,7 @@ class MessageReader:
         :return: short read
         """
 
-        return struct.unpack('>h', self._next(2))[0]
+        return self._unpack(_SHORT)
 
     def read_int(self):
         """
@@ -218,7 +312,7 @@ class MessageReader:
         :return: int read
         """
 
-        return struct.unpack('>i', self._next(4))[0]
+        return self._unpack(_INT)
 
     def read_long(self):
         """
@@ -227,7 +321,7 @@ class MessageReader:
         :return: long read
         """
 
-        return struct.unpack('>q', self._next(8))[0]
+        return self._unpack(_LONG)
 
     def read_float(self):
         """
@@ -236,7 +330,7 @@ class MessageReader:
         :return: float read
         """
 
-        return struct.unpack('>f', self._next(4))[0]
+        return self._unpack(_FLOAT)
 
     def read_double(self):
         """
@@ -245,7 +339,7 @@ class MessageReader:
         :return: double read
         """
 
-        return struct.unpack('>d', self._next(8))[0]
+        return self._unpack(_DOUBLE)
 
     def read_raw(self, length):
         """
@@ -262,7 +356,99 @@ class MessageReader:
 
         :return: data read
         """
-        return self.data[self.cursor:]
+        return bytes(self.data[self.cursor:])
+
+
+# Receive buffer size, messages bigger than this grow it
+_RECEIVE_CAPACITY = 64 * 1024
+
+# Type length and data length in front of every message
+_TYPE_LENGTH = _SHORT
+_DATA_LENGTH = _INT
+
+
+class _ReceiveBuffer:
+    # Reads from the socket into one reusable buffer with recv_into and
+    # splits out whole messages where they lie. Incomplete messages stay
+    # in the buffer until the rest arrives. The complete ones are copied
+    # out together, since they are handled after the buffer is reused.
+
+    def __init__(self, capacity=_RECEIVE_CAPACITY):
+        self.buffer = bytearray(capacity)
+        self.start = 0 # First byte not parsed yet
+        self.end = 0 # One past the last byte received
+
+    def clear(self):
+        self.start = 0
+        self.end = 0
+
+    def _make_room(self, count):
+        # Makes sure count bytes fit after the unparsed data
+
+        unparsed = self.end - self.start
+        if unparsed + count > len(self.buffer):
+            # A new buffer holding only the unparsed data
+            grown = bytearray(max(unparsed + count, 2 * len(self.buffer)))
+            grown[:unparsed] = self.buffer[self.start:self.end]
+            self.buffer = grown
+        elif self.end + count > len(self.buffer):
+            self.buffer[:unparsed] = self.buffer[self.start:self.end]
+        else:
+            return
+
+        self.start = 0
+        self.end = unparsed
+
+    def receive(self, sock):
+        # Reads whatever fits in one call, returns how many bytes arrived
+
+        if self.end == len(self.buffer):
+            self._make_room(len(self.buffer) // 2)
+
+        count = sock.recv_into(memoryview(self.buffer)[self.end:])
+        if count == 0:
+            raise ConnectionError('Messenger server closed the connection')
+
+        self.end += count
+        return count
+
+    def messages(self):
+        # Returns (type, data) of every complete message. All their bytes are
+        # copied out in one go and each data is a view into that copy.
+
+        first = self.start
+        found = [] # (type, data start, data end) in the buffer
+        missing = 0 # Bytes still to come of an incomplete message
+        header = _TYPE_LENGTH.size
+        while self.end - self.start >= header:
+            type_len = _TYPE_LENGTH.unpack_from(self.buffer, self.start)[0]
+            data_start = self.start + header + type_len + _DATA_LENGTH.size
+            if self.end < data_start:
+                missing = data_start - self.end
+                break
+
+            data_len = _DATA_LENGTH.unpack_from(self.buffer, data_start - _DATA_LENGTH.size)[0]
+            data_end = data_start + data_len
+            if self.end < data_end:
+                missing = data_end - self.end
+                break
+
+            message_type = self.buffer[self.start + header:data_start - _DATA_LENGTH.size].decode('utf-8')
+            found.append((message_type, data_start - first, data_end - first))
+            self.start = data_end
+
+        if found:
+            with memoryview(self.buffer) as view:
+                copy = memoryview(bytes(view[first:self.start]))
+            found = [(message_type, copy[start:end]) for message_type, start, end in found]
+
+        if self.start == self.end:
+            self.clear()
+        elif missing:
+            # Make sure the whole message will fit once it arrives
+            self._make_room(missing)
+
+        return found
 
 
 # Built-in messages
@@ -270,42 +456,48 @@ _HEARTBEAT = '_Heartbeat'
 _LISTEN = '_Listen'
 _DISCONNECT = '_Disconnect'
 
+# What a full send queue does with another message
+SEND_DROP_OLDEST = 'drop_oldest' # Throw away the oldest queued message
+SEND_DROP_NEWEST = 'drop_newest' # Throw away the new message
+SEND_COALESCE = 'coalesce' # Newer messages replace queued ones of the same type, full queues drop the oldest
 
-def _heartbeat_thread(msg):
-    # Sends a heartbeat message once per second to keep the
-    # connection alive
+SEND_POLICIES = (SEND_DROP_OLDEST, SEND_DROP_NEWEST, SEND_COALESCE)
 
-    while not msg.heartbeat_event.is_set():
-        msg._send_message(_HEARTBEAT, b'')
-        time.sleep(1)
+# Defaults for the client's timing and queue
+DEFAULT_SEND_QUEUE_SIZE = 64 # Messages waiting to be sent, not counting built-in ones
+DEFAULT_RECEIVE_QUEUE_SIZE = 256 # Received messages waiting for read_messages()
+DEFAULT_HEARTBEAT_INTERVAL = 1 # Seconds between heartbeats
+DEFAULT_MIN_BACKOFF = 0.5 # Seconds before the first reconnect attempt
+DEFAULT_MAX_BACKOFF = 8 # Longest wait between reconnect attempts, in seconds
+DEFAULT_CLOSE_TIMEOUT = 1 # Seconds disconnect() waits for queued messages to go out
 
+# What connect_ex returns for a connection that is on its way
+_CONNECT_PENDING = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
 
-def _connect_thread(msg):
-    # Repeatedly tries to connect to the server until successful
+# sendmsg writes several buffers at once, but isn't on every platform
+_HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
 
-    while not msg.connected and not msg.connect_event.is_set():
-        try:
-            msg.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            msg.socket.connect((msg.host, msg.port))
+# Most messages and bytes handed to one sendmsg call
+_MAX_SEND_BUFFERS = 512
+_MAX_SEND_BYTES = 256 * 1024
+
+# Placed in the send queue to close the connection once everything
+# before it has been sent
+_CLOSE = object()
 
-            msg._send(_encode_string(msg.name))
-            msg.connected = True
 
-            for listen in msg.listening:
-                msg._listen(listen)
-        except Exception:
-            if msg.log_errors:
-                print('Messenger connection failed')
+def _encode_string(str):
+    # Encodes a string into a length-prefixed UTF-8 bytes object, the
+    # length is of the encoded bytes like Java's writeUTF
 
-        time.sleep(1)
-    msg.connect_thread = None
+    encoded = str.encode("utf-8")
+    return struct.pack(">H", len(encoded)) + encoded
 
 
-def _encode_string(str):
-    # Encodes a string into a length-prefixed UTF-8 bytes object
+def _encode_message(type, data):
+    # The whole message as it goes over the wire
 
-    encoded_len = struct.pack(">h", len(str))
-    return encoded_len + str.encode("utf-8")
+    return b''.join((_encode_string(type), _DATA_LENGTH.pack(len(data)), data))
 
 
 class WildcardHandler:
@@ -336,9 +528,18 @@ class MessengerClient:
     """
     Represents a connection to the Messenger server.
     This can be used to send messages between processes.
+
+    One background thread owns the socket. It connects and reconnects
+    with backoff, sends heartbeats, sends queued messages and receives
+    incoming ones. Sending only queues the message, so it never waits on
+    the network. Received messages wait until read_messages() hands them
+    to the handlers on the caller's thread.
     """
 
-    def __init__(self, host, port, name, mute_errors=False):
+    def __init__(self, host, port, name, mute_errors=False,
+                 send_queue_size=DEFAULT_SEND_QUEUE_SIZE, send_policy=SEND_COALESCE,
+                 receive_queue_size=DEFAULT_RECEIVE_QUEUE_SIZE, heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+                 min_backoff=DEFAULT_MIN_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF):
         """
         Creates a new instance and attempts to connect to a
         Messenger server at the given address.
@@ -346,23 +547,70 @@ class MessengerClient:
         :param host: server host
         :param port: server port
         :param name: unique string used in logging
+        :param mute_errors: don't print connection errors
+        :param send_queue_size: messages that can wait to be sent
+        :param send_policy: what a full send queue does, one of SEND_POLICIES
+        :param receive_queue_size: received messages kept until read_messages(),
+            the oldest are dropped past this
+        :param heartbeat_interval: seconds between heartbeats
+        :param min_backoff: seconds before the first reconnect attempt
+        :param max_backoff: longest wait between reconnect attempts
         """
 
+        if send_policy not in SEND_POLICIES:
+            raise ValueError(f"Send policy must be one of {SEND_POLICIES}, not '{send_policy}'")
+
         self.host = host
         self.port = port
         self.name = name
         self.log_errors = not mute_errors
 
-        self.socket = None
-        self.connected = False
+        self.send_queue_size = send_queue_size
+        self.send_policy = send_policy
+        self.heartbeat_interval = heartbeat_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
 
-        self.heartbeat_event = threading.Event()
-        self.heartbeat_thread = threading.Thread(target=_heartbeat_thread, args=(self,))
-        self.heartbeat_thread.start()
         self.listening = []
         self.handlers = []
 
-        self._start_connect_thread()
+        # Shared with the background thread
+        self.lock = threading.Lock()
+        self.outgoing = deque() # [type, encoded message, built-in, batch] entries, or _CLOSE
+        self.queued = 0 # Entries in outgoing that count towards the limit
+        self.latest = {} # Queued entry of each type, for coalescing
+        self.batch_depth = 0 # Open batch() blocks, nothing is written while above 0
+        self.batch_number = 0 # Messages of the same batch are never coalesced
+        self.incoming = deque(maxlen=receive_queue_size) # (type, data) waiting for read_messages
+        self.dropped = 0 # Messages thrown away by the send policy
+        self.dropped_incoming = 0 # Received messages nobody read in time
+        self.connected = False
+        self.closing = False
+        self.restart = False # Give up on the current connection attempt
+
+        # Held while writing, by whichever thread flushes
+        self.send_lock = threading.RLock()
+        self.socket = None
+        self.connecting = False
+        self.sending = deque() # Encoded messages taken from the queue, partly written ones first
+        self.next_heartbeat = 0
+
+        # Only used by the background thread
+        self.receiver = _ReceiveBuffer()
+        self.backoff = min_backoff
+        self.next_attempt = 0
+
+        # Other threads write a byte here to wake the background thread
+        self.selector = selectors.DefaultSelector()
+        self.wake_receiver, self.wake_sender = socket.socketpair()
+        self.wake_receiver.setblocking(False)
+        self.wake_sender.setblocking(False)
+        self.selector.register(self.wake_receiver, selectors.EVENT_READ)
+        self.wake_pending = False
+
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f"Messenger {name}", daemon=True)
+        self.thread.start()
 
     def reconnect(self, host, port, name):
         """
@@ -375,15 +623,18 @@ class MessengerClient:
         :return:
         """
 
-        self.host = host
-        self.port = port
-        self.name = name
-
-        self.send(_DISCONNECT)
-        self._disconnect_socket()
-        self.connected = False
+        with self.lock:
+            self.host = host
+            self.port = port
+            self.name = name
 
-        self._start_connect_thread()
+            # Say goodbye to the old server first, or try the new one now
+            if self.connected:
+                self._enqueue(_DISCONNECT, b'', control=True)
+                self.outgoing.append(_CLOSE)
+            else:
+                self.restart = True
+        self._wake()
 
     def read_messages(self):
         """
@@ -391,14 +642,12 @@ class MessengerClient:
         nothing. Message handlers will be invoked from this method.
         """
 
-        if not self.connected:
-            return
-
-        try:
-            while self._available():
-                self._read_message()
-        except Exception:
-            self._handle_error()
+        # Only what has arrived so far, so a busy server can't keep
+        # this going forever
+        for _ in range(len(self.incoming)):
+            message_type, data = self.incoming.popleft()
+            for handler in self.handlers:
+                handler.handle(message_type, data)
 
     def is_connected(self):
         """
@@ -408,20 +657,32 @@ class MessengerClient:
         """
         return self.connected
 
-    def disconnect(self):
+    def disconnect(self, timeout=DEFAULT_CLOSE_TIMEOUT):
         """
         Disconnects from the current server. After this method is called,
         this object should no longer be used. If you want to change servers,
-        use reconnect(...).
+        use reconnect(...). Messages already queued get up to timeout
+        seconds to be sent.
         """
 
-        self.send(_DISCONNECT)
-
-        self.heartbeat_event.set()
-        self.heartbeat_thread.join()
-
-        self._disconnect_socket()
-        self.connected = False
+        with self.lock:
+            self.closing = True
+            if self.connected:
+                self._enqueue(_DISCONNECT, b'', control=True)
+                self.outgoing.append(_CLOSE)
+            else:
+                self.running = False
+        self._wake()
+
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            self.running = False
+            self._wake()
+            self.thread.join()
+
+        self.selector.close()
+        self.wake_receiver.close()
+        self.wake_sender.close()
 
     def prepare(self, type):
         """
@@ -442,6 +703,48 @@ class MessengerClient:
         """
         self._send_message(type, b'')
 
+    @contextmanager
+    def batch(self):
+        """
+        Groups the messages sent inside a with block, such as everything
+        from one camera frame, so they go out together in one write when
+        the block ends. A message type sent again in a later batch replaces
+        the queued one if it hasn't gone out yet, so a slow connection
+        only gets the latest of each. Batches can be nested, the outermost
+        one sends.
+        """
+
+        with self.lock:
+            if self.batch_depth == 0:
+                self.batch_number += 1
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                done = self.batch_depth == 0
+            if done:
+                self.flush()
+
+    def flush(self):
+        """
+        Writes queued messages now, as far as the socket takes them without
+        blocking. Whatever doesn't fit is written by the background thread.
+        """
+
+        # Write on this thread unless the background thread is busy writing
+        if self.send_lock.acquire(blocking=False):
+            try:
+                done = self._write(force=True)
+            except OSError:
+                done = False # The background thread finds the error too
+            finally:
+                self.send_lock.release()
+            if done:
+                return
+        self._wake()
+
     def add_handler(self, type, handler):
         """
         Registers a message handler to handle incoming messages.
@@ -464,76 +767,333 @@ class MessengerClient:
             h = DirectHandler(type, handler)
         self.handlers.append(h)
 
-        if type not in self.listening:
+        with self.lock:
+            if type in self.listening:
+                return
+
+            # Sent again on every connect
             self.listening.append(type)
             if self.connected:
-                self._listen(type)
+                self._enqueue(_LISTEN, _encode_string(type), control=True)
+        self._wake()
+
+    def _send_message(self, type, data):
+        # Queues a message, nothing is kept while disconnected since it
+        # would be stale by the time a connection is made
+
+        if not self.connected or self.closing:
+            return
+
+        with self.lock:
+            self._enqueue(type, data)
+            if self.batch_depth:
+                return # Sent when the batch ends
+
+            # On its own, each message is a batch
+            self.batch_number += 1
+        self.flush()
+
+    def _enqueue(self, type, data, control=False):
+        # Adds a message to the send queue, applying the send policy. Built-in
+        # messages don't count towards the limit and are never dropped.
+        # Must hold the lock.
+
+        if not control:
+            entry = self.latest.get(type)
+            if entry is not None and self.send_policy == SEND_COALESCE and entry[3] != self.batch_number:
+                # Still waiting from an earlier frame, only the latest matters
+                entry[1] = _encode_message(type, data)
+                entry[3] = self.batch_number
+                self.dropped += 1
+                return
 
-    def _available(self):
-        readable = select.select([self.socket], [], [], 0)[0]
+            if self.queued >= self.send_queue_size:
+                self.dropped += 1
+                if self.send_policy == SEND_DROP_NEWEST:
+                    return
+                self._drop_oldest()
+
+        entry = [type, _encode_message(type, data), control, self.batch_number]
+        self.outgoing.append(entry)
+        if not control:
+            self.queued += 1
+            self.latest[type] = entry
+
+    def _drop_oldest(self):
+        # Must hold the lock
+
+        for entry in self.outgoing:
+            if entry is not _CLOSE and not entry[2]:
+                self.outgoing.remove(entry)
+                self._forget(entry)
+                return
 
-        return any(sock == self.socket for sock in readable)
+    def _forget(self, entry):
+        # Bookkeeping for an entry leaving the queue, must hold the lock
 
-    def _listen(self, type):
-        self.prepare(_LISTEN).add_string(type).send()
+        if not entry[2]:
+            self.queued -= 1
+            if self.latest.get(entry[0]) is entry:
+                del self.latest[entry[0]]
 
-    def _handle_error(self):
-        self._disconnect_socket()
+    def _wake(self):
+        # Interrupts the background thread's select, at most one byte is
+        # waiting at a time
 
+        if self.wake_pending:
+            return
+        self.wake_pending = True
+        try:
+            self.wake_sender.send(b'\0')
+        except OSError:
+            pass
+
+    def _log(self, message):
         if self.log_errors:
-            print("Messenger connection lost")
+            print(message)
 
-        self.connected = False
+    # Everything below runs on the background thread
 
-        self._start_connect_thread()
+    def _run(self):
+        while self.running:
+            if self.restart:
+                # A new address, start over with it straight away
+                self.restart = False
+                self._close_socket()
+                self.next_attempt = 0
+                self.backoff = self.min_backoff
 
-    def _read(self, count):
-        data = b""
-        while len(data) < count:
-            data += self.socket.recv(count - len(data))
-        return data
+            now = time.monotonic()
+            if self.socket is None and now >= self.next_attempt:
+                self._start_connect()
 
-    def _send(self, data):
-        total = 0
-        while total < len(data):
-            send = self.socket.send(data[total:])
-            if send == 0:
-                self._handle_error()
-                return
-            total += send
+            if self.connected and now >= self.next_heartbeat:
+                with self.lock:
+                    self._enqueue(_HEARTBEAT, b'', control=True)
+                    self.next_heartbeat = now + self.heartbeat_interval
 
-    def _send_message(self, type, data):
-        if not self.connected:
+            self._update_interest()
+
+            if self.connected:
+                timeout = self.next_heartbeat - now
+            elif self.socket is None:
+                timeout = self.next_attempt - now
+            else:
+                timeout = None # Connecting, the socket says when it is done
+            events = self.selector.select(max(timeout, 0) if timeout is not None else None)
+
+            for key, mask in events:
+                if key.fileobj is self.wake_receiver:
+                    # Drained before the flag is cleared, so a wake in between
+                    # can't lose its byte and leave the flag stuck. Anything
+                    # it asked for is picked up at the top of the loop.
+                    try:
+                        self.wake_receiver.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    self.wake_pending = False
+                    continue
+
+                try:
+                    if self.connecting:
+                        self._finish_connect()
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self._receive()
+                    if mask & selectors.EVENT_WRITE and self.socket is not None:
+                        with self.send_lock:
+                            self._write(close=True)
+                except OSError:
+                    self._connection_lost()
+
+        self._close_socket()
+
+    def _update_interest(self):
+        # Only wake up for writing while there is something to write
+
+        if self.socket is None:
             return
 
-        encoded_type = _encode_string(type)
-        encoded_data_len = struct.pack(">i", len(data))
-        encoded = encoded_type + encoded_data_len + data
+        if self.connecting:
+            events = selectors.EVENT_WRITE
+        else:
+            events = selectors.EVENT_READ
+            if self.sending or (self.outgoing and not self.batch_depth):
+                events |= selectors.EVENT_WRITE
+        self.selector.modify(self.socket, events)
 
-        # packet_len = struct.pack(">i", len(encoded))
-        # packet = packet_len + encoded
-        packet = encoded
+    def _start_connect(self):
+        with self.lock:
+            address = (self.host, self.port)
 
-        self._send(packet)
+        try:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setblocking(False)
+
+            # Messages are already grouped into as few writes as possible,
+            # waiting to fill a packet only adds latency
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            result = self.socket.connect_ex(address)
+        except OSError:
+            self._connect_failed()
+            return
 
-    def _start_connect_thread(self):
-        self.connect_event = threading.Event()
-        self.connect_thread = threading.Thread(target=_connect_thread, args=(self,))
-        self.connect_thread.start()
+        if result not in _CONNECT_PENDING:
+            self._connect_failed()
+            return
 
-    def _read_message(self):
-        type_len = struct.unpack('>h', self._read(2))[0]
-        message_type = self._read(type_len).decode('utf-8')
-        data_len = struct.unpack('>i', self._read(4))[0]
-        message_data = self._read(data_len)
+        self.connecting = True
+        self.selector.register(self.socket, selectors.EVENT_WRITE)
 
-        for handler in self.handlers:
-            handler.handle(message_type, message_data)
+    def _finish_connect(self):
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._connect_failed()
+            return
 
-    def _disconnect_socket(self):
-        if self.connect_thread is not None:
-            self.connect_event.set()
-            self.connect_thread.join()
-        self.connect_thread = None
+        self.connecting = False
+        self.backoff = self.min_backoff
+        self.receiver.clear()
+
+        # Say who we are, then ask for everything listened to so far
+        with self.send_lock, self.lock:
+            self.sending = deque([memoryview(_encode_string(self.name))])
+            self.outgoing.clear()
+            self.latest.clear()
+            self.queued = 0
+            for listen in self.listening:
+                self._enqueue(_LISTEN, _encode_string(listen), control=True)
+            self.connected = True
+            self.next_heartbeat = 0
+
+    def _connect_failed(self):
+        self._log('Messenger connection failed')
+        self._close_socket()
+
+        # Wait longer after every failed attempt
+        self.next_attempt = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def _connection_lost(self):
+        if self.connecting:
+            self._connect_failed()
+            return
+
+        self._log('Messenger connection lost')
+        self._close_socket()
+        self.next_attempt = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def _close_socket(self):
+        with self.send_lock:
+            with self.lock:
+                self.connected = False
+                self.outgoing.clear()
+                self.latest.clear()
+                self.queued = 0
+            self.connecting = False
+            self.sending.clear()
+
+            if self.socket is not None:
+                try:
+                    self.selector.unregister(self.socket)
+                except (KeyError, ValueError):
+                    pass
+                self.socket.close()
+                self.socket = None
+
+    def _receive(self):
+        try:
+            self.receiver.receive(self.socket)
+        except BlockingIOError:
+            return
 
-        self.socket.close()
+        # Handlers run later on another thread, so they get views of a copy
+        # the receive buffer makes. If read_messages() isn't being called
+        # the oldest messages make way for new ones.
+        for message in self.receiver.messages():
+            if len(self.incoming) == self.incoming.maxlen:
+                self.dropped_incoming += 1
+            self.incoming.append(message)
+
+    def _take_queued(self):
+        # Moves queued messages to the ones being written, up to a close,
+        # once the last write has fully gone out. Until then they stay in
+        # the queue where the send policy applies. Returns whether the close
+        # was reached. Must hold both locks.
+
+        if self.sending:
+            return False
+
+        count = 0
+        size = 0
+        while self.outgoing and count < _MAX_SEND_BUFFERS and size < _MAX_SEND_BYTES:
+            entry = self.outgoing[0]
+            if entry is _CLOSE:
+                return True
+
+            self.outgoing.popleft()
+            self._forget(entry)
+            self.sending.append(memoryview(entry[1]))
+            count += 1
+            size += len(entry[1])
+
+        # A heartbeat that is nearly due rides along instead of being a
+        # write of its own later
+        if self.sending and self.connected:
+            now = time.monotonic()
+            if now >= self.next_heartbeat - self.heartbeat_interval / 2:
+                self.sending.append(memoryview(_encode_message(_HEARTBEAT, b'')))
+                self.next_heartbeat = now + self.heartbeat_interval
+
+        return False
+
+    def _send_buffers(self, buffers):
+        # One system call for all of them where the platform allows it
+
+        if _HAS_SENDMSG:
+            return self.socket.sendmsg(buffers)
+        return self.socket.send(b''.join(buffers))
+
+    def _write(self, close=False, force=False):
+        # Writes as much as the socket takes without blocking, returns
+        # whether nothing is left. Open batches hold writing back unless
+        # forced. Only the background thread closes the connection when it
+        # reaches a close. Must hold the send lock.
+
+        if self.socket is None or self.connecting:
+            return False
+
+        while True:
+            with self.lock:
+                if self.batch_depth and not self.sending and not force:
+                    return False # Held until the batch ends
+                reached_close = self._take_queued()
+                more = bool(self.outgoing) and not reached_close
+
+            if self.sending:
+                try:
+                    sent = self._send_buffers(list(self.sending))
+                except BlockingIOError:
+                    return False
+
+                # Drop what went out, keep the rest of a partly sent message
+                while sent and sent >= len(self.sending[0]):
+                    sent -= len(self.sending.popleft())
+                if self.sending:
+                    self.sending[0] = self.sending[0][sent:]
+                    return False
+
+            if reached_close:
+                if close:
+                    # Everything before the close has gone out
+                    with self.lock:
+                        self.outgoing.popleft()
+                    self._close_socket()
+                    if self.closing:
+                        self.running = False
+                    else:
+                        self.next_attempt = 0
+                return False
+            if not more:
+                return True
@@ -0,0 +1,134 @@
+from collections import deque
+from threading import Condition, Thread
+from main import logger
+
+# What a full queue does when another item arrives
+BACKPRESSURE_BLOCK = 'block' # Wait for the next stage to take something
+BACKPRESSURE_DROP_OLDEST = 'drop_oldest' # Throw away the oldest item to keep latency low
+
+BACKPRESSURE_POLICIES = (BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_OLDEST)
+
+# Seconds a stage waits for input before checking if it should stop
+STAGE_POLL_INTERVAL = 0.1
+
+class _End: # Passed down the pipeline when the input has run out
+    pass
+
+END = _End()
+
+class StageQueue: # Bounded queue between two stages
+    def __init__(self, maxsize, policy):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Backpressure policy must be one of {BACKPRESSURE_POLICIES}, not '{policy}'")
+
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = deque()
+        self.condition = Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.condition:
+            if self.policy == BACKPRESSURE_BLOCK:
+                self.condition.wait_for(lambda: len(self.items) < self.maxsize or self.closed)
+            elif len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped += 1
+
+            if self.closed:
+                return
+
+            self.items.append(item)
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        # Returns None if nothing arrived in time
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+            if not self.items:
+                return None
+
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        # Wakes up everything waiting on this queue
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class Stage(Thread):
+    # Runs one step of the pipeline on its own thread. The first stage has no
+    # input and is called repeatedly to produce items. Returning None from
+    # the function skips the item, returning END stops the pipeline.
+    def __init__(self, name, function, input_queue, output_queue):
+        super().__init__(name=name, daemon=True)
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.running = True
+
+    def run(self):
+        while self.running:
+            if self.input_queue is None:
+                item = None
+            else:
+                item = self.input_queue.get(timeout=STAGE_POLL_INTERVAL)
+                if item is None:
+                    continue
+
+            if item is END:
+                result = END
+            else:
+                try:
+                    result = self.function() if self.input_queue is None else self.function(item)
+                except Exception:
+                    logger.exception(f"Pipeline stage '{self.name}' failed")
+                    continue
+
+            if result is not None:
+                self.output_queue.put(result)
+
+            if result is END:
+                break
+
+
+class Pipeline:
+    # Chain of stages with bounded queues between them. The output of the last
+    # stage is read with get(), usually from the main thread.
+    def __init__(self, queue_size, policy):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.stages = []
+        self.queues = []
+
+    def add_stage(self, name, function, policy=None):
+        # policy overrides the pipeline's policy for this stage's output
+        input_queue = self.queues[-1] if self.queues else None
+        output_queue = StageQueue(self.queue_size, policy or self.policy)
+
+        self.stages.append(Stage(name, function, input_queue, output_queue))
+        self.queues.append(output_queue)
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def get(self, timeout=None):
+        # Returns the next output, None on timeout, or END when finished
+        return self.queues[-1].get(timeout)
+
+    def dropped(self):
+        return {stage.name: queue.dropped for stage, queue in zip(self.stages, self.queues)}
+
+    def stop(self):
+        for stage in self.stages:
+            stage.running = False
+        for queue in self.queues:
+            queue.close()
+        for stage in self.stages:
+            stage.join()
@@ -0,0 +1,249 @@
+import bisect
+import time
+from threading import Lock, Thread
+import cv2
+import numpy as np
+from main import logger
+from quaternions import *
+
+# Defaults for the 'filter' section of solver.json
+DEFAULT_PUBLISH_RATE = 100 # Predicted poses sent per second
+DEFAULT_HISTORY = 0.5 # Seconds of measurements kept to replay late ones
+DEFAULT_ACCELERATION_NOISE = 4 # m/s^2 the robot can change speed by unexpectedly
+DEFAULT_ANGULAR_ACCELERATION_NOISE = 8 # rad/s^2
+DEFAULT_INITIAL_VELOCITY_SIGMA = 1 # m/s and rad/s, before anything is known
+DEFAULT_GATE = 22.5 # Squared Mahalanobis distance, 99.9% of 6 DoF measurements are within it
+DEFAULT_MAX_REJECTIONS = 5 # Rejected measurements in a row before the filter starts over
+DEFAULT_TIMEOUT = 1 # Seconds without measurements before the pose is unknown
+
+# Layout of the state: position, velocity, rotation error, angular velocity
+_POSITION = slice(0, 3)
+_VELOCITY = slice(3, 6)
+_ROTATION = slice(6, 9)
+_ANGULAR_VELOCITY = slice(9, 12)
+_STATE_SIZE = 12
+
+# Measurements are position and rotation
+_H = np.zeros((6, _STATE_SIZE))
+_H[0:3, _POSITION] = np.eye(3)
+_H[3:6, _ROTATION] = np.eye(3)
+
+def _exp(vector):
+    return cv2.Rodrigues(np.asarray(vector, dtype=np.float64).reshape(3, 1))[0]
+
+def _log(rotation):
+    return cv2.Rodrigues(rotation)[0].ravel()
+
+
+class _State: # Filter state at one point in time
+    def __init__(self, timestamp, position, velocity, rotation, angular_velocity, covariance):
+        self.timestamp = timestamp
+        self.position = position
+        self.velocity = velocity
+        self.rotation = rotation # Robot to field, angular velocity is in the robot's frame
+        self.angular_velocity = angular_velocity
+        self.covariance = covariance
+
+    def copy(self):
+        return _State(self.timestamp, self.position.copy(), self.velocity.copy(), self.rotation.copy(),
+                      self.angular_velocity.copy(), self.covariance.copy())
+
+
+class _Measurement: # A fused pose from one camera frame, and the state it led to
+    def __init__(self, timestamp, position, rotation, covariance):
+        self.timestamp = timestamp
+        self.position = position
+        self.rotation = rotation
+        self.covariance = covariance
+        self.state = None # State after this measurement
+        self.rejections = 0 # Measurements rejected in a row up to this one
+
+
+class PoseFilter:
+    # Error state Kalman filter over the robot's pose and velocity with a
+    # constant velocity model. Measurements are the fused poses of single
+    # camera frames with the time the frame was captured. Late ones are
+    # slotted into a short history and everything after them is replayed,
+    # so cameras can report in any order. predict() extrapolates to any
+    # time, so poses can be published independent of the frame rate.
+    def __init__(self, options):
+        self.history = options.get('history', DEFAULT_HISTORY)
+        self.acceleration_noise = options.get('acceleration_noise', DEFAULT_ACCELERATION_NOISE)
+        self.angular_acceleration_noise = options.get('angular_acceleration_noise', DEFAULT_ANGULAR_ACCELERATION_NOISE)
+        self.initial_velocity_sigma = options.get('initial_velocity_sigma', DEFAULT_INITIAL_VELOCITY_SIGMA)
+        self.gate = options.get('gate', DEFAULT_GATE)
+        self.max_rejections = options.get('max_rejections', DEFAULT_MAX_REJECTIONS)
+        self.timeout = options.get('timeout', DEFAULT_TIMEOUT)
+
+        self.lock = Lock()
+        self.measurements = [] # Sorted by timestamp
+        self.timestamps = []
+        self.state = None
+        self.dropped = 0 # Measurements too old to replay
+
+    def _initial_state(self, measurement):
+        covariance = np.zeros((_STATE_SIZE, _STATE_SIZE))
+        covariance[0:3, 0:3] = measurement.covariance[0:3, 0:3]
+        covariance[6:9, 6:9] = measurement.covariance[3:6, 3:6]
+        covariance[_VELOCITY, _VELOCITY] = np.eye(3) * self.initial_velocity_sigma ** 2
+        covariance[_ANGULAR_VELOCITY, _ANGULAR_VELOCITY] = np.eye(3) * self.initial_velocity_sigma ** 2
+
+        return _State(measurement.timestamp, measurement.position.copy(), np.zeros(3),
+                      measurement.rotation.copy(), np.zeros(3), covariance)
+
+    def _predict(self, state, timestamp):
+        # Moves a copy of the state forward (or back) to the given time
+        dt = timestamp - state.timestamp
+        predicted = state.copy()
+        predicted.timestamp = timestamp
+        predicted.position += state.velocity * dt
+        predicted.rotation = state.rotation @ _exp(state.angular_velocity * dt)
+
+        transition = np.eye(_STATE_SIZE)
+        transition[_POSITION, _VELOCITY] = np.eye(3) * dt
+        transition[_ROTATION, _ANGULAR_VELOCITY] = np.eye(3) * dt
+
+        # Random acceleration, integrated over the step
+        dt = abs(dt)
+        block = np.array([[dt ** 3 / 3, dt ** 2 / 2], [dt ** 2 / 2, dt]])
+        noise = np.zeros((_STATE_SIZE, _STATE_SIZE))
+        for value, rate, spectral in ((_POSITION, _VELOCITY, self.acceleration_noise ** 2),
+                                      (_ROTATION, _ANGULAR_VELOCITY, self.angular_acceleration_noise ** 2)):
+            noise[value, value] = np.eye(3) * block[0, 0] * spectral
+            noise[value, rate] = noise[rate, value] = np.eye(3) * block[0, 1] * spectral
+            noise[rate, rate] = np.eye(3) * block[1, 1] * spectral
+
+        predicted.covariance = transition @ state.covariance @ transition.T + noise
+        return predicted
+
+    def _correct(self, state, measurement):
+        # Returns the state updated with the measurement, or None if the
+        # measurement is too far from what was expected
+        predicted = self._predict(state, measurement.timestamp)
+
+        residual = np.concatenate([measurement.position - predicted.position,
+                                   _log(predicted.rotation.T @ measurement.rotation)])
+        innovation = _H @ predicted.covariance @ _H.T + measurement.covariance
+        distance = residual @ np.linalg.solve(innovation, residual)
+        if distance > self.gate:
+            return None
+
+        gain = predicted.covariance @ _H.T @ np.linalg.inv(innovation)
+        correction = gain @ residual
+
+        predicted.position += correction[_POSITION]
+        predicted.velocity += correction[_VELOCITY]
+        predicted.rotation = predicted.rotation @ _exp(correction[_ROTATION])
+        predicted.angular_velocity += correction[_ANGULAR_VELOCITY]
+
+        # Joseph form stays symmetric and positive
+        keep = np.eye(_STATE_SIZE) - gain @ _H
+        predicted.covariance = keep @ predicted.covariance @ keep.T + gain @ measurement.covariance @ gain.T
+        return predicted
+
+    def _replay(self, start):
+        # Runs the measurements from index start on again
+        state, rejections = None, 0
+        if start > 0:
+            state = self.measurements[start - 1].state
+            rejections = self.measurements[start - 1].rejections
+
+        for measurement in self.measurements[start:]:
+            if state is None or measurement.timestamp - state.timestamp > self.timeout:
+                state = self._initial_state(measurement)
+                rejections = 0
+            else:
+                corrected = self._correct(state, measurement)
+                if corrected is not None:
+                    state = corrected
+                    rejections = 0
+                else:
+                    rejections += 1
+                    if rejections >= self.max_rejections:
+                        # The robot really is somewhere else, or the filter is lost
+                        logger.info(f"Pose filter rejected {rejections} measurements in a row, restarting")
+                        state = self._initial_state(measurement)
+                        rejections = 0
+
+            measurement.state = state
+            measurement.rejections = rejections
+
+        self.state = state
+
+    def update(self, timestamp, estimate):
+        # Adds a fused pose (from PoseFusion) of a frame captured at timestamp
+        measurement = _Measurement(timestamp, np.array(estimate['position'], dtype=np.float64),
+                                   np.array(estimate['pose'], dtype=np.float64)[:3, :3],
+                                   np.array(estimate['covariance'], dtype=np.float64))
+
+        with self.lock:
+            if self.timestamps and timestamp < self.timestamps[-1] - self.history:
+                self.dropped += 1
+                return
+
+            index = bisect.bisect_right(self.timestamps, timestamp)
+            self.timestamps.insert(index, timestamp)
+            self.measurements.insert(index, measurement)
+            self._replay(index)
+
+            # Forget what is too old to be replayed, keeping the state before it
+            old = bisect.bisect_left(self.timestamps, self.timestamps[-1] - self.history)
+            if old > 1:
+                del self.timestamps[:old - 1]
+                del self.measurements[:old - 1]
+
+    def predict(self, timestamp):
+        # Pose at the given time in the same format as PoseFusion.fuse, plus
+        # velocities, or None if there is no recent enough measurement
+        with self.lock:
+            state = self.state
+            if state is None or timestamp - state.timestamp > self.timeout:
+                return None
+            predicted = self._predict(state, timestamp)
+
+        pose = np.eye(4)
+        pose[:3, :3] = predicted.rotation
+        pose[:3, 3] = predicted.position
+
+        covariance = np.empty((6, 6))
+        covariance[:3, :3] = predicted.covariance[_POSITION, _POSITION]
+        covariance[:3, 3:] = predicted.covariance[_POSITION, _ROTATION]
+        covariance[3:, :3] = predicted.covariance[_ROTATION, _POSITION]
+        covariance[3:, 3:] = predicted.covariance[_ROTATION, _ROTATION]
+
+        return {
+            'pose': pose,
+            'position': predicted.position,
+            'rotation': np.array(matrixToQuat(predicted.rotation)),
+            'covariance': covariance,
+            'velocity': predicted.velocity,
+            'angular_velocity': predicted.angular_velocity
+        }
+
+
+class PosePublisher(Thread):
+    # Calls publish with the filter's prediction for the current time at a
+    # fixed rate, whatever the cameras are doing
+    def __init__(self, pose_filter, publish, rate=DEFAULT_PUBLISH_RATE):
+        super().__init__(name='Pose publisher', daemon=True)
+        self.pose_filter = pose_filter
+        self.publish = publish
+        self.period = 1 / rate
+        self.running = True
+
+    def run(self):
+        next_time = time.perf_counter()
+        while self.running:
+            self.publish(self.pose_filter.predict(time.perf_counter()))
+
+            # Keep to the rate even if publishing takes a while
+            next_time += self.period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.perf_counter()
+
+    def stop(self):
+        self.running = False
+        self.join()
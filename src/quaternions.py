@@ -1,28 +1,31 @@
 import math
+import numpy as np
 
 def matrixToQuat(m):
     r11 = m[0][0]; r12 = m[0][1]; r13 = m[0][2]
     r21 = m[1][0]; r22 = m[1][1]; r23 = m[1][2]
     r31 = m[2][0]; r32 = m[2][1]; r33 = m[2][2]
 
-    q0 = math.sqrt((1 + r11 + r22 + r33) / 4)
-    q1 = math.sqrt((1 + r11 - r22 - r33) / 4)
-    q2 = math.sqrt((1 - r11 + r22 - r33) / 4)
-    q3 = math.sqrt((1 - r11 - r22 + r33) / 4)
+    q0 = math.sqrt(max(1 + r11 + r22 + r33, 0) / 4)
+    q1 = math.sqrt(max(1 + r11 - r22 - r33, 0) / 4)
+    q2 = math.sqrt(max(1 - r11 + r22 - r33, 0) / 4)
+    q3 = math.sqrt(max(1 - r11 - r22 + r33, 0) / 4)
 
-    if q0 > q1 and q0 > q2 and q0 > q3:
+    # Ties go to the first, otherwise no sign gets fixed for
+    # rotations like 90 degrees about an axis
+    if q0 >= q1 and q0 >= q2 and q0 >= q3:
         q1 = (r32 - r23) / (4 * q0)
         q2 = (r13 - r31) / (4 * q0)
         q3 = (r21 - r12) / (4 * q0)
-    elif q1 > q0 and q1 > q2 and q1 > q3:
+    elif q1 >= q2 and q1 >= q3:
         q0 = (r32 - r23) / (4 * q1)
         q2 = (r12 + r21) / (4 * q1)
         q3 = (r13 + r31) / (4 * q1)
-    elif q2 > q0 and q2 > q1 and q2 > q3:
+    elif q2 >= q3:
         q0 = (r13 - r31) / (4 * q2)
         q1 = (r12 + r21) / (4 * q2)
         q3 = (r23 + r32) / (4 * q2)
-    elif q3 > q0 and q3 > q1 and q3 > q2:
+    else:
         q0 = (r21 - r12) / (4 * q3)
         q1 = (r13 + r31) / (4 * q3)
         q2 = (r23 + r32) / (4 * q3)
@@ -33,12 +36,13 @@ def invertQuat(q):
     return (q[0], -q[1], -q[2], -q[3])
 
 def quatToAxisAngle(q):
-    if q[0] == 1:
-        return (0, (1, 0, 0))
-
-    theta = 2 * math.acos(q[0])
+    # Rounding can push w just past 1, and w = -1 is no rotation too
+    theta = 2 * math.acos(max(-1, min(1, q[0])))
 
     s = math.sin(theta / 2)
+    if abs(s) < 1e-12:
+        return (0, (1, 0, 0))
+
     x = q[1] / s
     y = q[2] / s
     z = q[3] / s
@@ -67,3 +71,124 @@ def quatToFUL(q):
     )
 
     return (forward, up, left)
+
+# The functions below work on stacks of quaternions, shape (..., 4), in the
+# same (w, x, y, z) order, so rotations of every detection in a frame can be
+# handled with array operations instead of a Python loop
+
+def matricesToQuats(m):
+    # Rotation part of (..., 3, 3) or (..., 4, 4) matrices to (..., 4)
+    m = np.asarray(m, dtype=np.float64)[..., :3, :3]
+    r11, r12, r13 = m[..., 0, 0], m[..., 0, 1], m[..., 0, 2]
+    r21, r22, r23 = m[..., 1, 0], m[..., 1, 1], m[..., 1, 2]
+    r31, r32, r33 = m[..., 2, 0], m[..., 2, 1], m[..., 2, 2]
+
+    # Each component is found from the diagonal, the largest is the most
+    # precise and the others follow from it. argmax gives ties to the first,
+    # same as matrixToQuat.
+    magnitudes = np.sqrt(np.maximum(np.stack([
+        1 + r11 + r22 + r33,
+        1 + r11 - r22 - r33,
+        1 - r11 + r22 - r33,
+        1 - r11 - r22 + r33
+    ], axis=-1), 0) / 4)
+    largest = np.argmax(magnitudes, axis=-1)[..., None]
+    divisor = 4 * np.take_along_axis(magnitudes, largest, axis=-1)[..., 0]
+
+    # Every component for each choice of the largest one, shape (..., 4, 4)
+    candidates = np.stack([
+        np.stack([magnitudes[..., 0] * divisor, r32 - r23, r13 - r31, r21 - r12], axis=-1),
+        np.stack([r32 - r23, magnitudes[..., 1] * divisor, r12 + r21, r13 + r31], axis=-1),
+        np.stack([r13 - r31, r12 + r21, magnitudes[..., 2] * divisor, r23 + r32], axis=-1),
+        np.stack([r21 - r12, r13 + r31, r23 + r32, magnitudes[..., 3] * divisor], axis=-1)
+    ], axis=-2)
+
+    return np.take_along_axis(candidates, largest[..., None], axis=-2)[..., 0, :] / divisor[..., None]
+
+def quatsToMatrices(q):
+    # (..., 4) to rotation matrices (..., 3, 3)
+    q = np.asarray(q, dtype=np.float64)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    return np.stack([
+        np.stack([1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)], axis=-1),
+        np.stack([2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)], axis=-1),
+        np.stack([2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)], axis=-1)
+    ], axis=-2)
+
+def invertQuats(q):
+    return np.asarray(q, dtype=np.float64) * [1, -1, -1, -1]
+
+def multiplyQuats(a, b):
+    # Hamilton products, a and b broadcast against each other
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    aw, ax, ay, az = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    bw, bx, by, bz = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+
+    return np.stack([
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw
+    ], axis=-1)
+
+def quatsToAxisAngles(q):
+    # Angles (...) in [0, pi] and unit axes (..., 3). No rotation, however
+    # close, gets the x axis.
+    q = np.asarray(q, dtype=np.float64)
+
+    # q and -q are the same rotation, the one with w >= 0 is the short way
+    q = q * np.where(q[..., :1] < 0, -1, 1)
+    sines = np.linalg.norm(q[..., 1:], axis=-1)
+    angles = 2 * np.arctan2(sines, q[..., 0])
+
+    stable = sines > 1e-12
+    axes = np.where(stable[..., None], q[..., 1:] / np.where(stable, sines, 1)[..., None], [1, 0, 0])
+    return angles, axes
+
+def quatsToRotationVectors(q):
+    # Axis times angle, shape (..., 3)
+    q = np.asarray(q, dtype=np.float64)
+    q = q * np.where(q[..., :1] < 0, -1, 1)
+    vectors = q[..., 1:]
+    sines = np.linalg.norm(vectors, axis=-1)
+    angles = 2 * np.arctan2(sines, q[..., 0])
+
+    # Small angles have no stable axis, the vector part is enough there
+    ratio = np.where(sines > 1e-9, angles / np.where(sines > 1e-9, sines, 1), 2)
+    return vectors * ratio[..., None]
+
+def slerpQuats(a, b, t):
+    # Rotations t of the way from a to b along the shortest path, a, b and
+    # t broadcast against each other
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)[..., None]
+
+    cosines = np.sum(a * b, axis=-1, keepdims=True)
+    b = b * np.where(cosines < 0, -1, 1)
+    cosines = np.abs(cosines)
+
+    # Nearly equal rotations interpolate linearly, sin(theta) is ~0 there
+    theta = np.arccos(np.clip(cosines, -1, 1))
+    sines = np.sin(theta)
+    close = sines < 1e-6
+    sines = np.where(close, 1, sines)
+    start = np.where(close, 1 - t, np.sin((1 - t) * theta) / sines)
+    end = np.where(close, t, np.sin(t * theta) / sines)
+
+    result = start * a + end * b
+    return result / np.linalg.norm(result, axis=-1, keepdims=True)
+
+def averageQuats(q, weights=None):
+    # Weighted mean rotation of (N, 4) by Markley et al., the eigenvector
+    # of the largest eigenvalue of the weighted sum of outer products. Signs
+    # of the inputs don't matter, the result has w >= 0.
+    q = np.asarray(q, dtype=np.float64)
+    if weights is None:
+        weights = np.ones(len(q))
+
+    _, vectors = np.linalg.eigh(np.einsum('n,ni,nj->ij', weights, q, q))
+    mean = vectors[:, -1]
+    return -mean if mean[0] < 0 else mean
@@ -0,0 +1,10 @@
+# Why a detection wasn't used. The detector's filter and the solver both
+# report these, so they live apart from either.
+REJECT_FAMILY = 'family' # Tag of the wrong family
+REJECT_UNKNOWN_TAG = 'unknown_tag' # ID isn't in the environment
+REJECT_MARGIN = 'margin' # Decision margin too low
+REJECT_HAMMING = 'hamming' # Too many bits corrected
+REJECT_AREA = 'area' # Tag too small in the image
+REJECT_NO_POSE = 'no_pose' # apriltag couldn't find a pose
+REJECT_TRANSLATION = 'translation' # Robot position too far from the consensus
+REJECT_ROTATION = 'rotation' # Robot rotation too far from the consensus
@@ -0,0 +1,129 @@
+import numpy as np
+
+# Defaults for the 'roi_tracking' section of detector.json
+DEFAULT_FULL_SCAN_INTERVAL = 10 # Frames between full frame scans
+DEFAULT_PADDING = 0.5 # Added around each predicted box, as a fraction of its size
+DEFAULT_MIN_REGION = 48 # Smallest region searched, in pixels
+
+def offset_detection(result, x, y):
+    # Moves a detection found in a crop back into full frame coordinates
+    offset = np.array([x, y], dtype=np.float64)
+    translation = np.array([
+        [1, 0, x],
+        [0, 1, y],
+        [0, 0, 1]
+    ], dtype=np.float64)
+
+    return result._replace(corners=result.corners + offset,
+                           center=result.center + offset,
+                           homography=translation @ result.homography)
+
+def _merge_regions(regions):
+    # Joins overlapping regions so no part of the frame is searched twice
+    merged = []
+    for region in sorted(regions):
+        for i, other in enumerate(merged):
+            if region[0] < other[2] and other[0] < region[2] and region[1] < other[3] and other[1] < region[3]:
+                merged[i] = (min(region[0], other[0]), min(region[1], other[1]),
+                             max(region[2], other[2]), max(region[3], other[3]))
+                break
+        else:
+            merged.append(region)
+
+    # Merging can create new overlaps
+    if len(merged) != len(regions):
+        return _merge_regions(merged)
+    return merged
+
+
+class _Track: # Where a tag was last seen and how fast it is moving in the image
+    def __init__(self, corners):
+        self.box = self._box(corners)
+        self.velocity = np.zeros(2)
+
+    @staticmethod
+    def _box(corners):
+        return np.concatenate([corners.min(axis=0), corners.max(axis=0)])
+
+    def update(self, corners):
+        box = self._box(corners)
+        self.velocity = (box[:2] + box[2:]) / 2 - (self.box[:2] + self.box[2:]) / 2
+        self.box = box
+
+    def predict(self, padding, min_region):
+        # Box around where the tag should be in the next frame
+        center = (self.box[:2] + self.box[2:]) / 2 + self.velocity
+        half = (self.box[2:] - self.box[:2]) / 2 * (1 + 2 * padding) + np.abs(self.velocity)
+        half = np.maximum(half, min_region / 2)
+        return np.concatenate([center - half, center + half])
+
+
+class RoiTracker:
+    # Detects tags only in padded regions around where they were last seen,
+    # with a scan of the full frame every few frames or when a tag is lost.
+    # Keep one per camera.
+    def __init__(self, options):
+        self.full_scan_interval = options.get('full_scan_interval', DEFAULT_FULL_SCAN_INTERVAL)
+        self.padding = options.get('padding', DEFAULT_PADDING)
+        self.min_region = options.get('min_region', DEFAULT_MIN_REGION)
+
+        self.tracks = {}
+        self.frames_since_scan = 0
+
+    def _full_scan(self, detector, gray, accept):
+        results = detector.detect(gray)
+        if accept is not None:
+            results = accept(results)
+
+        # Tags that weren't found are dropped, the rest keep their motion
+        tracks = {}
+        for result in results:
+            track = self.tracks.get(result.tag_id)
+            if track is None:
+                track = _Track(result.corners)
+            else:
+                track.update(result.corners)
+            tracks[result.tag_id] = track
+
+        self.tracks = tracks
+        self.frames_since_scan = 0
+        return results
+
+    def detect(self, detector, gray, accept=None):
+        # accept optionally filters a list of detections
+        if not self.tracks or self.frames_since_scan >= self.full_scan_interval:
+            return self._full_scan(detector, gray, accept)
+        self.frames_since_scan += 1
+
+        height, width = gray.shape[:2]
+        regions = []
+        for track in self.tracks.values():
+            x0, y0, x1, y1 = track.predict(self.padding, self.min_region)
+            x0, y0 = max(int(x0), 0), max(int(y0), 0)
+            x1, y1 = min(int(np.ceil(x1)), width), min(int(np.ceil(y1)), height)
+            if x1 > x0 and y1 > y0:
+                regions.append((x0, y0, x1, y1))
+
+        # Keep the best decode of each tag in case regions found the same one
+        found = {}
+        for x0, y0, x1, y1 in _merge_regions(regions):
+            for result in detector.detect(gray[y0:y1, x0:x1]):
+                result = offset_detection(result, x0, y0)
+                best = found.get(result.tag_id)
+                if best is None or result.decision_margin > best.decision_margin:
+                    found[result.tag_id] = result
+
+        if accept is not None:
+            found = {result.tag_id: result for result in accept(list(found.values()))}
+
+        # A lost tag might have moved anywhere, so look everywhere
+        if any(tag_id not in found for tag_id in self.tracks):
+            return self._full_scan(detector, gray, accept)
+
+        for tag_id, result in found.items():
+            if tag_id in self.tracks:
+                self.tracks[tag_id].update(result.corners)
+            else:
+                self.tracks[tag_id] = _Track(result.corners)
+
+        return list(found.values())
@@ -1,17 +1,15 @@
-from itertools import product
+import numpy as np
 from messenger import *
 
 def _write_matrix(builder, matrix):
-    # Write as column major
-    for col, row in product(range(4), range(4)):
-        # Float here since ShuffleLog stores matrices as float
-        builder.add_float(matrix[row][col])
+    # Column major floats, since ShuffleLog stores matrices as float
+    builder.add_matrix4(matrix)
 
 class ShuffleLogAPI:
     _MSG_QUERY_ENVIRONMENT = "TagTracker:QueryEnvironment"
     _MSG_ENVIRONMENT = "TagTracker:Environment"
 
-    def __init__(self, conn_params, tag_infos, camera_infos):
+    def __init__(self, conn_params, environment, camera_infos):
         host = conn_params['host']
         port = conn_params['port']
         name = conn_params['name']
@@ -20,7 +18,7 @@ class ShuffleLogAPI:
         self.msg = MessengerClient(host, port, name, mute_errors=mute_errors)
         self.msg.add_handler(ShuffleLogAPI._MSG_QUERY_ENVIRONMENT, lambda t, r: self._on_query_environment(t, r))
         
-        self.tag_infos = tag_infos
+        self.environment = environment
         self.camera_infos = camera_infos
 
     def read(self):
@@ -29,6 +27,10 @@ class ShuffleLogAPI:
     def shutdown(self):
         self.msg.disconnect()
 
+    def batch(self):
+        # Everything published inside goes out in one write at the end
+        return self.msg.batch()
+
     # This is temporary
     def publish_detection_data(self, detections):
         builder = self.msg.prepare('TagTracker:TestData')
@@ -42,24 +44,26 @@ class ShuffleLogAPI:
     def publish_test_matrices(self, matrices):
         builder = self.msg.prepare('TagTracker:TestMtx')
         builder.add_int(len(matrices))
-        for matrix in matrices:
-            _write_matrix(builder, matrix)
+        if len(matrices):
+            # All of them at once
+            _write_matrix(builder, np.asarray(matrices))
         builder.send()
 
     def _on_query_environment(self, type, reader):
         print('[debug] sending environment data to ShuffleLog')
         builder = self.msg.prepare(ShuffleLogAPI._MSG_ENVIRONMENT)
 
-        builder.add_int(len(self.tag_infos))
-        for tag in self.tag_infos:
-            builder.add_double(tag['size'])
-            builder.add_int(tag['id'])
-            _write_matrix(builder, tag['transform'])
+        environment = self.environment
+        builder.add_int(len(environment))
+        for tag_id, size, transform in zip(environment.ids, environment.sizes, environment.transforms):
+            builder.add_double(size)
+            builder.add_int(int(tag_id))
+            _write_matrix(builder, transform)
         
         builder.add_int(len(self.camera_infos))
         for camera in self.camera_infos:
             builder.add_string(camera['name'])
-            builder.add_int(camera['port'])
+            builder.add_int(camera.get('port', -1)) # Recorded sources have no port
             _write_matrix(builder, camera['robot_pose'])
 
         builder.send()
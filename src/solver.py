@@ -1,6 +1,12 @@
 # Solves for robot position based on results of found tags
 import numpy as np
 from main import logger
+from environment import *
+from fusion import PoseFusion
+from joint_solver import JointPoseSolver
+from consensus import *
+from rejections import *
+from ambiguity import AmbiguityResolver
 
 # TODO-Ryan: Finish/Fix
 
@@ -51,76 +57,182 @@ def invert(m):
 		det *  (m00 * a1212 - m01 * a0212 + m02 * a0112)  \
 	]).reshape(4, 4)
 
+# How the tags of a frame are combined, set with 'mode' in solver.json
+SOLVER_FUSION = 'fusion' # Weighted average of each tag's pose
+SOLVER_JOINT = 'joint' # One least squares solve over every tag corner
+SOLVER_MODES = (SOLVER_FUSION, SOLVER_JOINT)
+
+# Reasons the solver can leave a detection out
+SOLVER_REJECT_REASONS = (REJECT_FAMILY, REJECT_UNKNOWN_TAG, REJECT_NO_POSE, REJECT_TRANSLATION, REJECT_ROTATION)
+
 class RobotPoseSolver:
-	def __init__(self, environment_dict):
-		# Unpack tag positions into lookup dictionary
-		if not environment_dict['tags']:
-			logger.error('No tags defined! Quitting')
-			raise AssertionError('No tags defined in environment JSON')
-		self.tags_dict = {tag['id']: tag for tag in environment_dict['tags']}
-		self.tag_family = environment_dict['tag_family']
+	def __init__(self, environment, options={}):
+		# Tags are already checked and stacked into arrays by Environment
+		self.environment = environment
+		self.tag_family = environment.tag_family
+
+		# apriltag reports the family as bytes
+		self.tag_family_bytes = self.tag_family.encode()
 
 		if self.tag_family != "tag16h5":
 			'''logger.warning('Are you sure that you want to look for, tags in the \
 				family {}. FRC uses 16h5'.format(self.tag_family))
 			'''
-	def solve(self, detection_poses):
-		# Master list of estimated poses to be combined
-		estimated_poses_list = []
 
-		# Apply camera and tag pose to estimated pose
+		# Inverse of each camera's position on the robot, by camera name
+		self.camera_inverses = {}
+
+		# Combines the estimates of all tags into one pose, either by
+		# weighting each tag's estimate or by solving all corners together
+		self.mode = options.get('mode', SOLVER_FUSION)
+		if self.mode not in SOLVER_MODES:
+			raise ValueError(f"Solver mode must be one of {SOLVER_MODES}, not '{self.mode}'")
+		self.fusion = PoseFusion(options.get('fusion', {}))
+		self.joint = JointPoseSolver(environment, options.get('joint', {}))
+
+		# Optionally picks between the two poses a planar tag fits instead
+		# of taking apriltag's
+		ambiguity_options = options.get('ambiguity', {})
+		self.ambiguity = AmbiguityResolver(environment, ambiguity_options) \
+			if ambiguity_options.get('enabled', False) else None
+
+		# Optionally drops tags whose robot pose disagrees with the rest
+		consensus_options = options.get('consensus', {})
+		self.consensus = PoseConsensus(consensus_options) if consensus_options.get('enabled', False) else None
+		self.last_pose = None
+		self.last_time = None
+
+		# Detections left out of the last solve, as dicts with the tag,
+		# camera and reason, and how many were left out for each reason so far
+		self.rejections = []
+		self.rejected = dict.fromkeys(SOLVER_REJECT_REASONS, 0)
+
+	def _reject(self, pose_dict, reason, meters=None, degrees=None):
+		self.rejected[reason] += 1
+		self.rejections.append({
+			'tag_id': pose_dict['tag_id'],
+			'camera': pose_dict['camera'].name,
+			'reason': reason,
+			'translation': meters,
+			'rotation': degrees
+		})
+
+	def _camera_inverse(self, camera):
+		inverse = self.camera_inverses.get(camera.name)
+		if inverse is None:
+			inverse = invert(np.reshape(camera.robot_position, (4, 4)).astype(np.float64))
+			self.camera_inverses[camera.name] = inverse
+		return inverse
+
+	def solve(self, detection_poses, timestamp=None):
+		self.rejections = []
+
+		# Pick out the detections of known tags
+		detections = []
+		estimated_poses = []
+		tag_indices = []
+		camera_inverses = []
+		errors = []
+		margins = []
 		for pose_dict in detection_poses:
-			estimated_pose = pose_dict['pose']
-			camera_pose = pose_dict['camera'].robot_position
-			tag_id = pose_dict['tag_id']
-			tag_family = pose_dict['tag_family']
-
-			# Find the tag info that matches that tag
-			if self.tag_family not in str(tag_family):
-				logger.warning(f"Found a tag that doesn't belong to {self.tag_family}")
+			# Find the tag info that matches that tag. The detection filter
+			# usually drops these already, so they are only counted.
+			if self.tag_family_bytes not in pose_dict['tag_family']:
+				self._reject(pose_dict, REJECT_FAMILY)
 				continue
 
-			# Get the info for the tag
-			tag_dict = self.tags_dict.get(tag_id)
-
-			if not tag_dict:
-				logger.warning(f"Found a tag that isn't defined in environment. ID: {tag_id}")
+			index = self.environment.row(pose_dict['tag_id'])
+			if index < 0:
+				self._reject(pose_dict, REJECT_UNKNOWN_TAG)
 				continue
 
-			tag_pose = tag_dict['transform']
-
-			# Convert to numpy arrarys for math
-			estimated_pose = np.array(estimated_pose)
-			camera_pose = np.array(camera_pose)
-			tag_pose = np.array(tag_pose)
-
-			# Scale estimated position by tag size
-			size = tag_dict['size']
-			estimated_pose[0][3] *= size
-			estimated_pose[1][3] *= size
-			estimated_pose[2][3] *= size
-
-			# Find where the camera is if the tag is at the origin
-			tag_relative_camera_pose = invert(estimated_pose)
-
-			# Find the camera position relative to the tag position
-			world_camera_pose = np.matmul(tag_pose, tag_relative_camera_pose)
-
-			# Find the position of the robot from the camera position
-			inv_rel_camera_pose = invert(camera_pose)
-			robot_pose = np.matmul(world_camera_pose, inv_rel_camera_pose)
-
-			estimated_poses_list.append(robot_pose)
-
-		# Combine poses with average (just for position, not rotation)
+			detections.append(pose_dict)
+			estimated_poses.append(pose_dict['pose'])
+			tag_indices.append(index)
+			camera_inverses.append(self._camera_inverse(pose_dict['camera']))
+			errors.append(pose_dict['error'])
+			margins.append(pose_dict['detection'].decision_margin)
 
-		if not estimated_poses_list:
+		if not estimated_poses:
 			# If we have no samples, report none
-			return (None, estimated_poses_list)
-			
-		# TODO: Figure out rotation
-		total = np.array([0.0, 0.0, 0.0])
-		for pose in estimated_poses_list:
-			total += np.array([pose[0][3], pose[1][3], pose[2][3]])
-		average = total / len(estimated_poses_list)
-		return (average, estimated_poses_list)
+			return (None, [])
+
+		# All detections of the frame at once, shape (N, 4, 4)
+		estimated_poses = np.array(estimated_poses, dtype=np.float64)
+		tag_indices = np.array(tag_indices)
+		camera_inverses = np.array(camera_inverses)
+		errors = np.array(errors, dtype=np.float64)
+		margins = np.array(margins, dtype=np.float64)
+
+		if self.ambiguity is not None:
+			# Tag poses in meters, which also exist for tags seen head on
+			prior = (self.last_pose, self.last_time) if self.last_pose is not None else None
+			# Its errors replace apriltag's, which are missing for exactly
+			# the tags it found poses for
+			estimated_poses, errors, choices = self.ambiguity.resolve(detections, tag_indices, camera_inverses, prior, timestamp)
+			logger.debug(f"Tag poses picked by {choices}")
+
+		# apriltag can fail to find a pose for a tag seen exactly head on.
+		# Their corners are still good for the joint solve, unless only
+		# tags that agree with each other are wanted.
+		valid = np.all(np.isfinite(estimated_poses), axis=(1, 2)) & np.isfinite(errors)
+		corner_detections = detections
+		corner_indices = tag_indices
+		if not np.all(valid):
+			logger.debug(f"Ignoring {np.count_nonzero(~valid)} tags without a pose")
+			if self.consensus is not None or self.mode != SOLVER_JOINT:
+				for pose_dict in [detections[i] for i in np.flatnonzero(~valid)]:
+					self._reject(pose_dict, REJECT_NO_POSE)
+				if not np.any(valid):
+					return (None, [])
+
+			detections = [detections[i] for i in np.flatnonzero(valid)]
+			estimated_poses = estimated_poses[valid]
+			tag_indices = tag_indices[valid]
+			camera_inverses = camera_inverses[valid]
+			errors = errors[valid]
+			margins = margins[valid]
+
+		# Scale estimated position by tag size
+		if self.ambiguity is None:
+			estimated_poses[:, :3, 3] *= self.environment.sizes[tag_indices, None]
+
+		# Find the camera position relative to the tag position, then the
+		# position of the robot from the camera position
+		world_camera_poses = self.environment.transforms[tag_indices] @ invert_rigid(estimated_poses)
+		robot_poses = world_camera_poses @ camera_inverses.reshape(-1, 4, 4)
+
+		# How much each tag can be trusted
+		scales = self.fusion.uncertainty(estimated_poses, errors, margins, pixels=self.ambiguity is not None)
+
+		# Throw out tags that disagree before any more work is done on them
+		if self.consensus is not None:
+			prior = self.last_pose
+			if prior is not None and timestamp is not None and self.last_time is not None \
+					and timestamp - self.last_time > self.consensus.prior_timeout:
+				prior = None
+
+			inliers, rejections = self.consensus.select(robot_poses, 1 / scales ** 2, prior)
+			for index, reason, meters, degrees in rejections:
+				self._reject(detections[index], reason, meters, degrees)
+
+			if rejections:
+				detections = [detections[i] for i in np.flatnonzero(inliers)]
+				robot_poses = robot_poses[inliers]
+				tag_indices = tag_indices[inliers]
+				scales = scales[inliers]
+			corner_detections = detections
+			corner_indices = tag_indices
+
+		if self.mode == SOLVER_JOINT:
+			# Single tag poses are where the joint solve starts from
+			estimate = self.joint.solve(corner_detections, corner_indices, robot_poses, timestamp)
+		else:
+			# Combine poses, trusting each by how good its detection was
+			estimate = self.fusion.fuse(robot_poses, scales)
+
+		if estimate is not None:
+			estimate['rejected'] = self.rejections
+			self.last_pose = estimate['pose']
+			self.last_time = timestamp
+		return (estimate, list(robot_poses))
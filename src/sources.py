@@ -0,0 +1,254 @@
+import os
+import time
+from abc import ABC, abstractmethod
+import cv2
+import numpy as np
+from main import logger
+from synthetic import TagSceneRenderer, Trajectory
+from environment import load_environment
+
+# Where a camera's frames come from, set with 'source' in cameras.json
+SOURCE_DEVICE = 'device' # A physical camera (the default, uses 'port')
+SOURCE_VIDEO = 'video' # A recorded video file
+SOURCE_IMAGES = 'images' # A directory of images, played in name order
+SOURCE_FRAMES = 'frames' # A list of frames already in memory
+SOURCE_SYNTHETIC = 'synthetic' # Rendered tags with a known robot pose
+
+# How recorded sources are paced
+PACING_FAST = 'fast' # As fast as the pipeline takes them
+PACING_REALTIME = 'realtime' # At the speed they were recorded
+PACING_FIXED = 'fixed' # At a fixed 'fps'
+
+PACING_MODES = (PACING_FAST, PACING_REALTIME, PACING_FIXED)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+DEFAULT_FPS = 30
+
+class _Pacer: # Sleeps so frames are handed out at the configured rate
+    def __init__(self, pacing, fps):
+        if pacing not in PACING_MODES:
+            raise ValueError(f"Pacing must be one of {PACING_MODES}, not '{pacing}'")
+
+        self.pacing = pacing
+        self.fps = fps
+        self.start = None
+        self.index = 0
+
+    def restart(self):
+        self.start = None
+        self.index = 0
+
+    def wait(self, frame_time=None):
+        # frame_time is when the frame was recorded, in seconds from the start
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+
+        if self.pacing == PACING_REALTIME and frame_time is not None:
+            target = self.start + frame_time
+        else:
+            target = self.start + self.index / self.fps
+        self.index += 1
+
+        if self.pacing != PACING_FAST and target > now:
+            time.sleep(target - now)
+
+
+class FrameSource(ABC): # Base for everything a camera can read from
+    def __init__(self, options, camera):
+        # Lossless sources wait for each frame to be processed before
+        # reading the next one, so replays are repeatable
+        pacing = options.get('pacing', PACING_FAST)
+        self.lossless = options.get('lossless', pacing == PACING_FAST)
+        self.finished = False
+
+        # Where the robot really was for the last frame, if known
+        self.ground_truth = None
+
+    @abstractmethod
+    def read(self):
+        # Returns (ret, frame) like cv2.VideoCapture.read
+        pass
+
+    def release(self):
+        pass
+
+
+class DeviceSource(FrameSource):
+    def __init__(self, options, camera):
+        super().__init__(options, camera)
+        self.lossless = False
+        self.capture = cv2.VideoCapture(options['port'])
+
+    def read(self):
+        return self.capture.read()
+
+    def release(self):
+        self.capture.release()
+
+
+class VideoFileSource(FrameSource):
+    def __init__(self, options, camera):
+        super().__init__(options, camera)
+        self.path = options['path']
+        self.loop = options.get('loop', False)
+
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(f"Could not find video file '{self.path}'")
+
+        self.capture = cv2.VideoCapture(self.path)
+        fps = options.get('fps') or self.capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS
+        self.pacer = _Pacer(options.get('pacing', PACING_FAST), fps)
+
+    def read(self):
+        ret, frame = self.capture.read()
+
+        if not ret and self.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.pacer.restart()
+            ret, frame = self.capture.read()
+
+        if not ret:
+            self.finished = True
+            return ret, frame
+
+        self.pacer.wait(self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000)
+        return ret, frame
+
+    def release(self):
+        self.capture.release()
+
+
+class FrameListSource(FrameSource):
+    def __init__(self, options, camera, frames=None):
+        super().__init__(options, camera)
+        self.frames = frames if frames is not None else options['frames']
+        self.loop = options.get('loop', False)
+        self.index = 0
+        self.pacer = _Pacer(options.get('pacing', PACING_FAST), options.get('fps', DEFAULT_FPS))
+
+        if not self.frames:
+            raise ValueError("Frame source has no frames")
+
+    def _load(self, index):
+        return self.frames[index]
+
+    def read(self):
+        if self.index >= len(self.frames):
+            if not self.loop:
+                self.finished = True
+                return False, None
+            self.index = 0
+            self.pacer.restart()
+
+        frame = self._load(self.index)
+        self.index += 1
+
+        if frame is None:
+            return False, None
+
+        self.pacer.wait()
+        return True, frame
+
+
+class ImageDirectorySource(FrameListSource):
+    def __init__(self, options, camera):
+        path = options['path']
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"Could not find image directory '{path}'")
+
+        files = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+        files = [os.path.join(path, name) for name in files]
+
+        # Preloading keeps image decoding out of the measured frame rate
+        if options.get('preload', False):
+            files = [cv2.imread(file) for file in files]
+        self.preloaded = options.get('preload', False)
+
+        super().__init__(options, camera, files)
+
+    def _load(self, index):
+        if self.preloaded:
+            return self.frames[index]
+
+        frame = cv2.imread(self.frames[index])
+        if frame is None:
+            logger.error(f"Could not read image '{self.frames[index]}'")
+        return frame
+
+
+class SyntheticSource(FrameSource):
+    # Renders the environment's tags from a scripted robot trajectory, using
+    # the camera's intrinsics and robot pose, and reports the true robot pose
+    def __init__(self, options, camera):
+        super().__init__(options, camera)
+
+        environment = load_environment(options.get('environment', 'environment.json'))
+
+        # Default to the resolution the camera was calibrated at
+        width = options.get('width', int(round(2 * camera.camera_params[2])))
+        height = options.get('height', int(round(2 * camera.camera_params[3])))
+
+        distortion = camera.dist_coeffs if options.get('distort', True) else np.zeros(5)
+        self.renderer = TagSceneRenderer(environment, camera.matrix, distortion,
+                                         camera.robot_position, (width, height),
+                                         options.get('background', 128))
+
+        self.trajectory = Trajectory(options.get('trajectory', [{'position': [0, 0, 0]}]))
+        self.duration = options.get('duration', self.trajectory.duration)
+        self.loop = options.get('loop', False)
+
+        # Trajectory time comes from the frame number, so every run and every
+        # camera with the same fps sees the same poses whatever the pacing
+        self.fps = options.get('fps', DEFAULT_FPS)
+        self.pacer = _Pacer(options.get('pacing', PACING_FAST), self.fps)
+        self.index = 0
+
+        self.noise = options.get('noise', 0)
+        self.random = np.random.default_rng(options.get('seed', 0))
+
+    def read(self):
+        time = self.index / self.fps
+        if time > self.duration:
+            if not self.loop:
+                self.finished = True
+                return False, None
+            self.index = 0
+            self.pacer.restart()
+            time = 0
+
+        robot_pose = self.trajectory.pose(time)
+        image = self.renderer.render(robot_pose)
+
+        if self.noise:
+            noise = self.random.normal(0, self.noise, image.shape)
+            image = np.clip(image + noise, 0, 255).astype(np.uint8)
+
+        self.index += 1
+        self.ground_truth = robot_pose
+
+        self.pacer.wait()
+        return True, cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+
+_SOURCE_TYPES = {
+    SOURCE_DEVICE: DeviceSource,
+    SOURCE_VIDEO: VideoFileSource,
+    SOURCE_IMAGES: ImageDirectorySource,
+    SOURCE_FRAMES: FrameListSource,
+    SOURCE_SYNTHETIC: SyntheticSource
+}
+
+def open_source(camera_options, camera):
+    # Cameras without a 'source' are physical cameras on 'port'
+    options = dict(camera_options.get('source') or {})
+    source_type = options.setdefault('type', SOURCE_DEVICE)
+    if source_type == SOURCE_DEVICE:
+        options.setdefault('port', camera_options.get('port'))
+
+    if source_type not in _SOURCE_TYPES:
+        raise ValueError(f"Unknown source type '{source_type}', must be one of {tuple(_SOURCE_TYPES)}")
+
+    # Sources get the camera for its calibration and placement on the robot
+    return _SOURCE_TYPES[source_type](options, camera)
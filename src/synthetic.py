@@ -0,0 +1,168 @@
+import math
+import cv2
+import numpy as np
+from undistortion import undistort_points
+
+# Codes of the tag16h5 family, bit 15 is the top left data cell
+TAG16H5_CODES = [
+    0x231b, 0x2ea5, 0x346a, 0x45b9, 0x79a6, 0x7f6b, 0xb358, 0xe745,
+    0xfe59, 0x156d, 0x380b, 0xf0ab, 0x0d84, 0x4736, 0x8c72, 0xaf10,
+    0x093c, 0x93b4, 0xa503, 0x468f, 0xe137, 0x5795, 0xdf42, 0x1c1d,
+    0xe9dc, 0x73ad, 0xad5f, 0xd530, 0x07ca, 0xaf2e
+]
+
+# A tag16h5 image is 4x4 data cells inside a black border, inside a white border
+_TAG_CELLS = 8
+_TAG_DATA_CELLS = 4
+_CELL_PIXELS = 16 # Resolution the tag image is warped from
+
+# Tags closer than this to the camera plane are not drawn (meters)
+_NEAR_PLANE = 0.05
+
+def make_tag_image(tag_id):
+    # Renders a tag16h5 tag, including its white border, as a grayscale image
+    if not 0 <= tag_id < len(TAG16H5_CODES):
+        raise ValueError(f"tag16h5 has no tag with ID {tag_id}")
+
+    code = TAG16H5_CODES[tag_id]
+    cells = np.full((_TAG_CELLS, _TAG_CELLS), 255, dtype=np.uint8)
+    cells[1:-1, 1:-1] = 0
+
+    for bit in range(_TAG_DATA_CELLS * _TAG_DATA_CELLS):
+        if code >> (15 - bit) & 1:
+            row, col = divmod(bit, _TAG_DATA_CELLS)
+            cells[2 + row, 2 + col] = 255
+
+    size = _TAG_CELLS * _CELL_PIXELS
+    return cv2.resize(cells, (size, size), interpolation=cv2.INTER_NEAREST)
+
+def yaw_pose(position, yaw):
+    # Robot pose on the field from a position and a heading in degrees
+    # about the field's Z axis
+    pose = np.eye(4)
+    c = math.cos(math.radians(yaw))
+    s = math.sin(math.radians(yaw))
+    pose[:2, :2] = [[c, -s], [s, c]]
+    pose[:3, 3] = position
+    return pose
+
+class Trajectory: # Robot path through scripted waypoints, interpolated linearly
+    def __init__(self, waypoints):
+        if not waypoints:
+            raise ValueError("A trajectory needs at least one waypoint")
+
+        waypoints = sorted(waypoints, key=lambda point: point.get('time', 0))
+        self.times = np.array([point.get('time', 0) for point in waypoints], dtype=np.float64)
+        self.positions = np.array([point['position'] for point in waypoints], dtype=np.float64)
+        self.yaws = np.array([point.get('yaw', 0) for point in waypoints], dtype=np.float64)
+
+        self.duration = self.times[-1]
+
+    def pose(self, time):
+        # Before the first waypoint and after the last, the robot stands still
+        position = [np.interp(time, self.times, self.positions[:, i]) for i in range(3)]
+        yaw = np.interp(time, self.times, self.yaws)
+        return yaw_pose(position, yaw)
+
+
+class TagSceneRenderer:
+    # Draws the tags of an environment as seen by one camera on the robot
+    def __init__(self, environment, matrix, distortion, robot_to_camera, size, background=128):
+        self.matrix = np.array(matrix, dtype=np.float64).reshape(3, 3)
+        self.distortion = np.array(distortion, dtype=np.float64).reshape(-1)
+        self.robot_to_camera = np.array(robot_to_camera, dtype=np.float64).reshape(4, 4)
+        self.width, self.height = size
+        self.background = background
+
+        if 'tag16h5' not in environment.tag_family:
+            raise ValueError("Only tag16h5 tags can be rendered")
+
+        # Corners of the tag image, including its white border, in the tag's
+        # frame for a tag of size 1 (X right, Y down, Z into the tag)
+        half = 0.5 * _TAG_CELLS / (_TAG_CELLS - 2)
+        self.unit_corners = np.array([
+            [-half, -half, 0, 1],
+            [ half, -half, 0, 1],
+            [ half,  half, 0, 1],
+            [-half,  half, 0, 1]
+        ], dtype=np.float64)
+
+        # Same corners in tag image pixels, at the outside edge of the pixels
+        edge = _TAG_CELLS * _CELL_PIXELS - 0.5
+        self.image_corners = np.array([
+            [-0.5, -0.5],
+            [edge, -0.5],
+            [edge, edge],
+            [-0.5, edge]
+        ], dtype=np.float32)
+
+        self.tags = []
+        for tag_id, transform, size in zip(environment.ids, environment.transforms, environment.sizes):
+            self.tags.append({
+                'id': int(tag_id),
+                'transform': transform,
+                'size': size,
+                'image': make_tag_image(int(tag_id))
+            })
+        self.tag_inverses = environment.inverses
+
+        # Lens distortion is applied with one cached remap of the ideal image
+        self.distort_maps = None
+        if np.any(self.distortion):
+            grid_y, grid_x = np.mgrid[0:self.height, 0:self.width].astype(np.float32)
+            pixels = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1)
+            ideal = undistort_points(pixels, self.matrix, self.distortion).astype(np.float32)
+            ideal = ideal.reshape(self.height, self.width, 2)
+            self.distort_maps = (ideal[..., 0].copy(), ideal[..., 1].copy())
+
+    def render(self, robot_pose):
+        # Returns a grayscale image of the field seen from the given robot pose
+        camera_pose = robot_pose @ self.robot_to_camera
+        world_to_camera = np.linalg.inv(camera_pose)
+
+        canvas = np.full((self.height, self.width), self.background, dtype=np.uint8)
+
+        # Draw far tags first so closer ones cover them
+        visible = []
+        for tag, tag_inverse in zip(self.tags, self.tag_inverses):
+            tag_to_camera = world_to_camera @ tag['transform']
+
+            # The camera has to be in front of the tag to see it
+            camera_in_tag = tag_inverse @ camera_pose[:, 3]
+            if camera_in_tag[2] >= 0:
+                continue
+
+            corners = (tag_to_camera @ (self.unit_corners * [tag['size'], tag['size'], 1, 1]).T).T
+            if np.any(corners[:, 2] < _NEAR_PLANE):
+                continue
+
+            visible.append((tag_to_camera[2, 3], tag, corners))
+
+        for _, tag, corners in sorted(visible, key=lambda item: -item[0]):
+            projected = (self.matrix @ corners[:, :3].T).T
+            projected = projected[:, :2] / projected[:, 2:]
+            self._draw_tag(canvas, tag['image'], projected)
+
+        if self.distort_maps is not None:
+            canvas = cv2.remap(canvas, *self.distort_maps, cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_CONSTANT, borderValue=self.background)
+
+        return canvas
+
+    def _draw_tag(self, canvas, image, projected):
+        # Only warp the part of the frame the tag covers
+        x0, y0 = np.floor(projected.min(axis=0)).astype(int)
+        x1, y1 = np.ceil(projected.max(axis=0)).astype(int) + 1
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, self.width), min(y1, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        target = (projected - [x0, y0]).astype(np.float32)
+        homography = cv2.getPerspectiveTransform(self.image_corners, target)
+
+        region = canvas[y0:y1, x0:x1]
+        warped = cv2.warpPerspective(image, homography, (x1 - x0, y1 - y0), dst=region.copy(),
+                                     flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_TRANSPARENT)
+        canvas[y0:y1, x0:x1] = warped
+
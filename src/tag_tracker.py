@@ -1,8 +1,118 @@
 from cameras import *
 from gui import *
+from undistortion import *
+from roi_tracker import RoiTracker
+from detection_filter import DetectionFilter
+from adaptive import AdaptiveController
+import time
+from concurrent.futures import ThreadPoolExecutor
 import apriltag
+import numpy as np
 import cv2
 
+# Corners of a tag in the tag's own (-1..1) coordinates, in the order
+# that apriltag reports them
+TAG_CORNERS = np.array([
+    [-1, -1],
+    [ 1, -1],
+    [ 1,  1],
+    [-1,  1]
+], dtype=np.float32)
+
+def replace_corners(result, corners):
+    # Returns a copy of a detection with new corners, rebuilding the
+    # homography and center so that detection_pose uses the new corners
+    corners = np.asarray(corners, dtype=np.float64).reshape(4, 2)
+    homography = cv2.getPerspectiveTransform(TAG_CORNERS, corners.astype(np.float32))
+
+    center = homography @ np.array([0.0, 0.0, 1.0])
+    center = center[:2] / center[2]
+
+    return result._replace(corners=corners, center=center, homography=homography)
+
+# Defaults for the 'multi_resolution' section of detector.json
+DEFAULT_SEARCH_SCALE = 0.5 # Size of the image tags are searched in
+DEFAULT_REFINE_SAMPLES = 8 # Points sampled along each tag edge
+
+REFINE_STEP = 0.25 # Pixels between samples across an edge
+MIN_REFINE_EDGE = 8 # Shorter edges (in pixels) are not refined
+
+def refine_corners(gray, result, scale, samples=DEFAULT_REFINE_SAMPLES):
+    # Takes a detection from an image scaled down by scale and refines its
+    # corners to subpixel accuracy on the full resolution image. Each edge is
+    # found along its normal at several points, a line is fit through them
+    # and the corners are where the lines meet.
+
+    # apriltag puts pixel centers at +0.5, remap puts them at 0
+    corners = result.corners / scale - 0.5
+
+    starts = corners
+    directions = np.roll(corners, -1, axis=0) - corners # Edge i goes from corner i to i + 1
+    lengths = np.linalg.norm(directions, axis=1)
+    if np.min(lengths) < MIN_REFINE_EDGE:
+        return replace_corners(result, corners + 0.5)
+
+    units = directions / lengths[:, None]
+    normals = np.stack([-units[:, 1], units[:, 0]], axis=1)
+
+    # Point the normals out of the tag, where its black border meets white
+    outward = (starts + directions / 2) - corners.mean(axis=0)
+    normals *= np.sign(np.sum(normals * outward, axis=1))[:, None]
+
+    # Search a little further than the error the downscaling can cause
+    reach = 1 / scale + 1
+    steps = np.arange(-reach, reach + REFINE_STEP, REFINE_STEP)
+    along = np.linspace(0.15, 0.85, samples)
+
+    bases = starts[:, None, :] + along[None, :, None] * directions[:, None, :]
+    points = bases[:, :, None, :] + steps[None, None, :, None] * normals[:, None, None, :]
+    points = points.reshape(4 * samples, len(steps), 2).astype(np.float32)
+
+    # Intensity across the edge at every sample, all in one remap
+    profiles = cv2.remap(gray, points[..., 0], points[..., 1], cv2.INTER_LINEAR).astype(np.float64)
+    # Only dark to light counts, so the edges of data cells are ignored
+    gradients = np.maximum(np.diff(profiles, axis=1), 0)
+
+    # Strongest gradient, with a parabola through its neighbours for subpixel
+    best = np.clip(np.argmax(gradients, axis=1), 1, gradients.shape[1] - 2)
+    rows = np.arange(len(best))
+    left, middle, right = gradients[rows, best - 1], gradients[rows, best], gradients[rows, best + 1]
+    curvature = left - 2 * middle + right
+    shift = np.where(curvature < 0, 0.5 * (left - right) / np.where(curvature < 0, curvature, 1), 0)
+    offsets = steps[best] + (0.5 + shift) * REFINE_STEP
+
+    edge_points = bases + offsets.reshape(4, samples, 1) * normals[:, None, :]
+
+    # Line through each edge's points: mean and main direction
+    means = edge_points.mean(axis=1)
+    centered = edge_points - means[:, None, :]
+    _, vectors = np.linalg.eigh(np.einsum('eki,ekj->eij', centered, centered))
+    line_directions = vectors[:, :, 1]
+
+    refined = np.empty_like(corners)
+    for i in range(4):
+        # Corner i is where edge i - 1 meets edge i
+        a, b = i - 1, i
+        system = np.column_stack([line_directions[a], -line_directions[b]])
+        if abs(np.linalg.det(system)) < 1e-6:
+            return replace_corners(result, corners + 0.5)
+        t = np.linalg.solve(system, means[b] - means[a])
+        refined[i] = means[a] + t[0] * line_directions[a]
+
+    # Fall back to the scaled corners if an edge was fit to something else
+    if np.max(np.linalg.norm(refined - corners, axis=1)) > 2 * reach:
+        return replace_corners(result, corners + 0.5)
+
+    return replace_corners(result, refined + 0.5)
+
+# Settings of the native detector that a camera can override with the
+# 'detector' section of its entry in cameras.json
+CAMERA_SETTINGS = ('nthreads', 'quad_decimate', 'quad_blur', 'quad_sigma', 'refine_edges',
+                   'refine_decode', 'refine_pose', 'debug', 'quad_contours')
+
+# Threads detecting different cameras at once, 0 for one per camera
+DEFAULT_CAMERA_THREADS = 0
+
 class _DetectorOptions: # Converts JSON into object for apriltag's dector to read
     def __init__(self, dict=None):
         if dict:
@@ -10,52 +120,209 @@ class _DetectorOptions: # Converts JSON into object for apriltag's dector to rea
                 setattr(self, key, value)
 
 class Detector: # Rename?
-    def __init__(self, logger, options):
-        options = _DetectorOptions(options)
-        self.detector = apriltag.Detector(options)
+    def __init__(self, logger, options, draw=True, tag_family=None, tag_ids=None):
+        self.options = options
 
-    def getPoses(self, images):
+        # Each camera gets its own native detector with its own settings.
+        # They hold state while detecting, so can't be shared between the
+        # threads that detect cameras at once.
+        self.detectors = {}
+        self.camera_options = {}
+        self.camera_threads = options.get('camera_threads', DEFAULT_CAMERA_THREADS)
+        self.executor = None
+        self.executor_workers = 0
 
-        # Make a list of estimated poses to add to
-        estimated_poses = []
+        # Optionally drop likely false positives before anything else is
+        # done with them, tag_ids are the IDs in the environment
+        self.filter_options = options.get('filter', {})
+        self.tag_family = tag_family
+        self.tag_ids = tag_ids
+        self.filters = {}
+
+        # Optionally only search around tags seen in the last frame, this
+        # needs separate state for every camera
+        self.roi_options = options.get('roi_tracking', {})
+        self.roi_trackers = {}
 
-        # Find every target in the images
-        for image_dict in images:
-            image = image_dict['image']
-            camera = image_dict['camera']
+        # Optionally switch detector settings to stay within a latency budget
+        self.adaptive_options = options.get('adaptive', {})
+        self.controllers = {}
 
-            # Convert image to grayscale
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # Optionally find tags in a smaller image and refine their corners
+        # on the full resolution one
+        self.multires_options = options.get('multi_resolution', {})
 
-            # Find basic information about tag (center location, ID, family...)
-            results = self.detector.detect(gray)
+        # Latest detection latency, profile and rejected counts of each camera
+        self.camera_status = {}
 
-            # Estimate the pose of the camera relative to each target
-            for result in results:
-                # Undistort corners
+        # Drawing is skipped when nothing will show the images
+        self.draw = draw
 
-                # print(result.corners)
-                # for j in range(len(result.corners)):
-                #     result.corners[j] = cv2.undistortPoints(result.corners[j].reshape(-1, 2), camera.matrix, dist_coeffs, P=new_mtx).reshape(-1)
-                # print(result.corners)
+    def detect(self, image, camera):
+        # Finds the tags in one image and estimates their poses
+        tic = time.perf_counter()
 
-                pose, e0, e1 = self.detector.detection_pose(result, camera.camera_params)
+        detector = self._detector(camera)
+        controller = self._controller(camera)
+        if controller is not None:
+            controller.apply(detector)
 
-                # Draw bounding box
+        # Convert image to grayscale
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        # Find basic information about tag (center location, ID, family...)
+        results = self._find_tags(detector, gray, camera)
+
+        estimated_poses = []
+
+        # Estimate the pose of the camera relative to each target
+        for result in results:
+            # Undistort just the corners instead of the whole frame
+            pose_result = result
+            if camera.undistort_mode == UNDISTORT_CORNERS:
+                corners = undistort_points(result.corners, camera.matrix, camera.dist_coeffs)
+                pose_result = replace_corners(result, corners)
+
+            pose, e0, e1 = detector.detection_pose(pose_result, camera.camera_params)
+
+            # Draw bounding box
+            if self.draw:
                 draw_bounding_box(image, result, camera.camera_params, pose)
 
-                # TODO Finish
-                # TODO: What are the 'e's?
-                # TODO: Scale pose by tag size
-                estimated_poses.append({
-                    'pose': pose,
-                    'camera': camera,
-                    'tag_id': result.tag_id,
-                    'tag_family' : result.tag_family
-                })
+            # TODO: Scale pose by tag size
+            # e0 and e1 are the object space error of the pose before and
+            # after apriltag refined it
+            estimated_poses.append({
+                'pose': pose,
+                'camera': camera,
+                'tag_id': result.tag_id,
+                'tag_family' : result.tag_family,
+                'detection': result,
+                'initial_error': e0,
+                'error': e1
+            })
+
+        seconds = time.perf_counter() - tic
+        if controller is not None:
+            controller.update(seconds, results)
+
+        detection_filter = self.filters.get(camera.name)
+        self.camera_status[camera.name] = {
+            'latency_ms': seconds * 1000,
+            'profile': controller.index if controller is not None else -1,
+            'rejected': dict(detection_filter.rejected) if detection_filter is not None else {}
+        }
+
+        return estimated_poses
+
+    def _options(self, camera):
+        # detector.json with the camera's own settings on top
+        options = self.camera_options.get(camera.name)
+        if options is None:
+            overrides = camera.detector_options
+            for key in overrides:
+                if key not in CAMERA_SETTINGS:
+                    raise ValueError(f"Detector setting '{key}' of {camera.name} can't be set per camera, "
+                                     f"only {CAMERA_SETTINGS} can")
+            options = {**self.options, **overrides}
+            self.camera_options[camera.name] = options
+        return options
+
+    def _detector(self, camera):
+        detector = self.detectors.get(camera.name)
+        if detector is None:
+            detector = apriltag.Detector(_DetectorOptions(self._options(camera)))
+            self.detectors[camera.name] = detector
+        return detector
+
+    def _controller(self, camera):
+        if not self.adaptive_options.get('enabled', False):
+            return None
+
+        controller = self.controllers.get(camera.name)
+        if controller is None:
+            controller = AdaptiveController(self.adaptive_options, self._options(camera), camera.name)
+            self.controllers[camera.name] = controller
+        return controller
+
+    def status(self):
+        # Detection latency and profile per camera, for reporting
+        return self.camera_status
+
+    def _filter(self, camera):
+        if not self.filter_options.get('enabled', False):
+            return None
+
+        detection_filter = self.filters.get(camera.name)
+        if detection_filter is None:
+            detection_filter = DetectionFilter(self.filter_options, self.tag_family, self.tag_ids)
+            self.filters[camera.name] = detection_filter
+        return detection_filter
 
-            # Log number of tags found
-            if estimated_poses:
-                logger.debug(f"Estimated pose on {len(estimated_poses)} AprilTags")
+    def _find_tags(self, detector, gray, camera):
+        multires = self.multires_options.get('enabled', False)
+
+        scale = 1
+        search = gray
+        if multires:
+            scale = self.multires_options.get('scale', DEFAULT_SEARCH_SCALE)
+            search = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        detection_filter = self._filter(camera)
+        accept = None
+        if detection_filter is not None:
+            accept = lambda results: detection_filter.apply(results, scale)
+
+        if not self.roi_options.get('enabled', False):
+            results = detector.detect(search)
+            if accept is not None:
+                results = accept(results)
+        else:
+            tracker = self.roi_trackers.get(camera.name)
+            if tracker is None:
+                tracker = RoiTracker(self.roi_options)
+                self.roi_trackers[camera.name] = tracker
+
+            # Filtered inside so false positives aren't tracked
+            results = tracker.detect(detector, search, accept)
+
+        if multires:
+            samples = self.multires_options.get('samples', DEFAULT_REFINE_SAMPLES)
+            results = [refine_corners(gray, result, scale, samples) for result in results]
+
+        return results
+
+    def getPoses(self, images):
+
+        # Make a list of estimated poses to add to
+        estimated_poses = []
+
+        # Find every target in the images. apriltag lets go of the GIL while
+        # it searches, so cameras are detected on threads at the same time.
+        if len(images) > 1 and self.camera_threads != 1:
+            # One thread per camera by default, grown when more cameras
+            # send frames at once than it was made for
+            workers = self.camera_threads or len(images)
+            if workers > self.executor_workers:
+                if self.executor is not None:
+                    self.executor.shutdown()
+                self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Detector')
+                self.executor_workers = workers
+            for poses in self.executor.map(lambda image_dict: self.detect(image_dict['image'], image_dict['camera']),
+                                           images):
+                estimated_poses.extend(poses)
+        else:
+            for image_dict in images:
+                estimated_poses.extend(self.detect(image_dict['image'], image_dict['camera']))
+
+        # Log number of tags found
+        if estimated_poses:
+            logger.debug(f"Estimated pose on {len(estimated_poses)} AprilTags")
 
         return estimated_poses
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.executor_workers = 0
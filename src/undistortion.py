@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+
+# Undistortion modes that can be set per camera in cameras.json
+UNDISTORT_NONE = 'none' # Use the raw frame
+UNDISTORT_FULL = 'full' # Remap every frame with cached tables
+UNDISTORT_CORNERS = 'corners' # Detect on the raw frame, undistort only tag corners
+
+UNDISTORT_MODES = (UNDISTORT_NONE, UNDISTORT_FULL, UNDISTORT_CORNERS)
+
+def undistort_points(points, matrix, distortion):
+    # Undistorts pixel coordinates, keeping them in pixel units of the
+    # original camera matrix so they match a fully undistorted frame
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+    undistorted = cv2.undistortPoints(points, matrix, distortion, P=matrix)
+    return undistorted.reshape(-1, 2)
+
+class Undistorter:
+    # Builds the initUndistortRectifyMap tables once and reuses them for every
+    # frame, instead of recomputing the camera matrix and undistorting the
+    # whole frame from scratch each time
+    def __init__(self, matrix, distortion):
+        self.matrix = np.array(matrix, dtype=np.float64).reshape(3, 3)
+        self.distortion = np.array(distortion, dtype=np.float64).reshape(-1)
+
+        self.map_x = None
+        self.map_y = None
+        self.size = None
+
+    def set_calibration(self, matrix, distortion):
+        # Maps are rebuilt lazily on the next frame
+        self.matrix = np.array(matrix, dtype=np.float64).reshape(3, 3)
+        self.distortion = np.array(distortion, dtype=np.float64).reshape(-1)
+        self.size = None
+
+    def _build_maps(self, width, height):
+        # Keep the original camera matrix as the new one so the undistorted
+        # image can be used with the same camera params for pose estimation
+        self.map_x, self.map_y = cv2.initUndistortRectifyMap(
+            self.matrix, self.distortion, None, self.matrix,
+            (width, height), cv2.CV_16SC2)
+        self.size = (width, height)
+
+    def undistort(self, frame):
+        height, width = frame.shape[:2]
+
+        if self.size != (width, height):
+            self._build_maps(width, height)
+
+        # A new image every frame, since the detector, drawing and the GUI
+        # can hold on to frames for as long as the pipeline queues them
+        return cv2.remap(frame, self.map_x, self.map_y, cv2.INTER_LINEAR)
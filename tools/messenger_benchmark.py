@@ -0,0 +1,169 @@
+import os
+import struct
+import sys
+import time
+from argparse import ArgumentParser
+import numpy as np
+
+# Measures how much TagTracker can publish to ShuffleLog each frame, by
+# publishing TagTracker:TestMtx through the real ShuffleLogAPI and
+# MessengerClient to the local stand-in server
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from messenger import SEND_POLICIES, SEND_COALESCE, DEFAULT_SEND_QUEUE_SIZE
+from shufflelog_api import ShuffleLogAPI
+from messenger_server import MessengerServer
+
+TEST_MATRICES = 'TagTracker:TestMtx'
+
+# Seconds to wait for the client to connect before giving up
+CONNECT_TIMEOUT = 5
+
+# The frame number is written into the first matrix, where it is exact as a
+# float up to 2^24, so the server can tell when each frame was published.
+# It sits after the int32 matrix count.
+_SEQUENCE = struct.Struct('>f')
+_SEQUENCE_OFFSET = 4
+
+def _wait_for(condition, timeout):
+    # Returns seconds until condition() was true, or None on timeout
+    tic = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - tic > timeout:
+            return None
+        time.sleep(0.001)
+    return time.perf_counter() - tic
+
+class _NoEnvironment: # ShuffleLogAPI only needs this to answer environment queries
+    ids = sizes = transforms = ()
+
+    def __len__(self):
+        return 0
+
+
+class _Arrivals: # What the server saw of each frame
+    def __init__(self):
+        self.times = {}
+        self.messages = 0
+        self.bytes = 0
+
+    def on_message(self, name, type, data, now):
+        if type == TEST_MATRICES and len(data) >= _SEQUENCE_OFFSET + _SEQUENCE.size:
+            self.times[int(_SEQUENCE.unpack_from(data, _SEQUENCE_OFFSET)[0])] = now
+        self.messages += 1
+        self.bytes += len(data)
+
+
+def run(matrix_count, duration, rate, policy, queue_size):
+    # Publishes frames of matrix_count matrices for duration seconds, at
+    # rate frames per second or as fast as possible if rate is 0
+    arrivals = _Arrivals()
+    server = MessengerServer('localhost', 0, on_message=arrivals.on_message).start()
+
+    api = ShuffleLogAPI({'host': 'localhost', 'port': server.port, 'name': 'Benchmark', 'mute_errors': True},
+                        _NoEnvironment(), [])
+    api.msg.send_policy = policy
+    api.msg.send_queue_size = queue_size
+    if _wait_for(api.msg.is_connected, CONNECT_TIMEOUT) is None:
+        raise RuntimeError(f"Benchmark client couldn't connect to the server on port {server.port}")
+
+    matrices = np.tile(np.eye(4), (max(matrix_count, 1), 1, 1))[:matrix_count]
+    sent = {}
+    publish_seconds = []
+
+    tic = time.perf_counter()
+    frame = 0
+    while time.perf_counter() - tic < duration:
+        frame += 1
+        if matrix_count:
+            matrices[0, 0, 0] = frame
+
+        # Same as the main loop does for each frame
+        start = time.perf_counter()
+        sent[frame] = start
+        with api.batch():
+            api.publish_test_matrices(matrices)
+        publish_seconds.append(time.perf_counter() - start)
+
+        if rate:
+            delay = tic + frame / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    # Let what is still queued arrive before counting
+    _wait_for(lambda: not api.msg.outgoing and not api.msg.sending, 1)
+    time.sleep(0.05)
+    elapsed = time.perf_counter() - tic
+
+    latencies = np.array([arrivals.times[frame] - sent[frame] for frame in arrivals.times if frame in sent]) * 1000
+    result = {
+        'frames': frame,
+        'delivered': len(arrivals.times),
+        'dropped': api.msg.dropped,
+        'messages_per_second': arrivals.messages / elapsed,
+        'bytes_per_second': arrivals.bytes / elapsed,
+        'publish_ms': np.percentile(publish_seconds, 99) * 1000,
+        'latency_ms': np.percentile(latencies, [50, 90, 99]) if len(latencies) else [np.nan] * 3,
+        'max_latency_ms': latencies.max() if len(latencies) else np.nan
+    }
+
+    api.shutdown()
+    server.stop()
+    return result
+
+def reconnect_time(min_backoff):
+    # Seconds from the server coming back until the client has connected
+    # and its listens are replayed, after losing the connection
+    server = MessengerServer('localhost', 0).start()
+    port = server.port
+
+    api = ShuffleLogAPI({'host': 'localhost', 'port': port, 'name': 'Benchmark', 'mute_errors': True},
+                        _NoEnvironment(), [])
+    api.msg.min_backoff = min_backoff
+    if _wait_for(lambda: server.clients(), CONNECT_TIMEOUT) is None:
+        raise RuntimeError(f"Benchmark client couldn't connect to the server on port {port}")
+
+    server.stop()
+    _wait_for(lambda: not api.msg.is_connected(), CONNECT_TIMEOUT)
+
+    # The client starts backing off now, with the server gone
+    server = MessengerServer('localhost', port).start()
+    seconds = _wait_for(lambda: any(connection.listening for connection in list(server.connections.values())),
+                        CONNECT_TIMEOUT)
+
+    api.shutdown()
+    server.stop()
+    return seconds
+
+def main():
+    parser = ArgumentParser(prog='Messenger benchmark',
+                            description='Measures publishing TagTracker:TestMtx to a local Messenger server')
+    parser.add_argument('-m', '--matrices', type=str, default='1,16,64,256,1024', metavar='', help='Comma separated matrix counts per frame to try')
+    parser.add_argument('-d', '--duration', type=float, default=2, metavar='', help='Seconds to publish for each count')
+    parser.add_argument('-r', '--rate', type=float, default=0, metavar='', help='Frames per second to publish, 0 for as fast as possible')
+    parser.add_argument('--policy', type=str, default=SEND_COALESCE, choices=SEND_POLICIES, help='What a full send queue does')
+    parser.add_argument('--queue_size', type=int, default=DEFAULT_SEND_QUEUE_SIZE, metavar='', help='Messages the send queue holds')
+    parser.add_argument('--min_backoff', type=float, default=0.5, metavar='', help='Seconds before the first reconnect attempt')
+
+    args = parser.parse_args()
+
+    rate = f"{args.rate:g} frames/s" if args.rate else "as fast as possible"
+    print(f"Publishing {TEST_MATRICES} for {args.duration:g} s per size, {rate}, {args.policy} policy")
+    print(f"{'matrices':>8} {'frames':>8} {'delivered':>9} {'dropped':>8} {'msg/s':>9} {'MiB/s':>8} "
+          f"{'publish p99 ms':>14} {'latency p50/p90/p99 ms':>24} {'max ms':>8}")
+
+    for matrix_count in [int(count) for count in args.matrices.split(',')]:
+        result = run(matrix_count, args.duration, args.rate, args.policy, args.queue_size)
+        latency = '/'.join(f"{value:.2f}" for value in result['latency_ms'])
+        print(f"{matrix_count:>8} {result['frames']:>8} {result['delivered']:>9} {result['dropped']:>8} "
+              f"{result['messages_per_second']:>9.0f} {result['bytes_per_second'] / 2 ** 20:>8.2f} "
+              f"{result['publish_ms']:>14.3f} {latency:>24} {result['max_latency_ms']:>8.2f}")
+
+    seconds = reconnect_time(args.min_backoff)
+    if seconds is None:
+        print(f"Client didn't reconnect within {CONNECT_TIMEOUT} s")
+    else:
+        print(f"Reconnect after the server came back: {seconds * 1000:.0f} ms (min backoff {args.min_backoff:g} s)")
+
+if __name__ == '__main__':
+    main()
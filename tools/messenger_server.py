@@ -0,0 +1,247 @@
+import selectors
+import socket
+import struct
+import threading
+import time
+from argparse import ArgumentParser
+
+# Stand-in for the Messenger server ShuffleLog connects TagTracker to, so
+# MessengerClient and ShuffleLogAPI can be run and measured without it.
+# Every message is a length-prefixed UTF-8 type, an int32 data length and
+# the data, all big endian. A client first sends its name as a
+# length-prefixed string, then asks for messages with _Listen, where a type
+# ending in '*' matches every type starting with what comes before.
+
+_HEARTBEAT = '_Heartbeat'
+_LISTEN = '_Listen'
+_DISCONNECT = '_Disconnect'
+
+_TYPE_LENGTH = struct.Struct('>H')
+_DATA_LENGTH = struct.Struct('>i')
+
+# Bytes read from a client at once
+RECEIVE_SIZE = 64 * 1024
+
+def encode_message(type, data=b''):
+    encoded = type.encode('utf-8')
+    return _TYPE_LENGTH.pack(len(encoded)) + encoded + _DATA_LENGTH.pack(len(data)) + data
+
+def _matches(pattern, type):
+    if pattern.endswith('*'):
+        return type.startswith(pattern[:-1])
+    return type == pattern
+
+
+class _Connection: # One connected client
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.address = address
+        self.name = None # Known once the client has said it
+        self.received = bytearray()
+        self.outgoing = bytearray()
+        self.listening = []
+        self.last_heard = time.perf_counter()
+
+    def next_frame(self):
+        # Takes the next complete string or message off the received data,
+        # returns None if it hasn't all arrived yet
+        if len(self.received) < _TYPE_LENGTH.size:
+            return None
+        type_end = _TYPE_LENGTH.size + _TYPE_LENGTH.unpack_from(self.received)[0]
+
+        if self.name is None:
+            if len(self.received) < type_end:
+                return None
+            name = self.received[_TYPE_LENGTH.size:type_end].decode('utf-8')
+            del self.received[:type_end]
+            return name, None
+
+        data_start = type_end + _DATA_LENGTH.size
+        if len(self.received) < data_start:
+            return None
+        data_end = data_start + _DATA_LENGTH.unpack_from(self.received, type_end)[0]
+        if len(self.received) < data_end:
+            return None
+
+        type = self.received[_TYPE_LENGTH.size:type_end].decode('utf-8')
+        data = bytes(self.received[data_start:data_end])
+        del self.received[:data_end]
+        return type, data
+
+
+class MessengerServer:
+    # Accepts any number of clients on one selector thread and passes each
+    # message on to every client listening for its type. on_message is
+    # called on that thread with the sending client's name, the type, the
+    # data and when it arrived (perf_counter), for measuring.
+    def __init__(self, host='localhost', port=5805, on_message=None, verbose=False):
+        self.on_message = on_message
+        self.verbose = verbose
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1] # Port 0 picks a free one
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.connections = {}
+
+        # Totals since starting, of messages other than the built-in ones
+        self.stats = {'connects': 0, 'disconnects': 0, 'heartbeats': 0, 'messages': 0, 'bytes': 0}
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='Messenger server', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def clients(self):
+        # Names of the clients that have said who they are
+        return [connection.name for connection in list(self.connections.values()) if connection.name is not None]
+
+    def run(self):
+        while self.running:
+            for key, mask in self.selector.select(0.1):
+                if key.fileobj is self.listener:
+                    self._accept()
+                    continue
+
+                connection = self.connections.get(key.fileobj)
+                if connection is None:
+                    continue
+                try:
+                    if mask & selectors.EVENT_READ:
+                        self._receive(connection)
+                    if mask & selectors.EVENT_WRITE and connection.socket in self.connections:
+                        self._send(connection)
+                except OSError:
+                    self._close(connection)
+
+        for connection in list(self.connections.values()):
+            self._close(connection)
+        self.selector.close()
+        self.listener.close()
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+
+    def _accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except BlockingIOError:
+            return
+
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections[sock] = _Connection(sock, address)
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.stats['connects'] += 1
+
+    def _close(self, connection):
+        if self.connections.pop(connection.socket, None) is None:
+            return
+
+        self.selector.unregister(connection.socket)
+        connection.socket.close()
+        self.stats['disconnects'] += 1
+        self._log(f"{connection.name or connection.address} disconnected")
+
+    def _receive(self, connection):
+        data = connection.socket.recv(RECEIVE_SIZE)
+        if not data:
+            self._close(connection)
+            return
+
+        now = time.perf_counter()
+        connection.last_heard = now
+        connection.received += data
+
+        while connection.socket in self.connections:
+            frame = connection.next_frame()
+            if frame is None:
+                break
+
+            type, data = frame
+            if data is None:
+                connection.name = type
+                self._log(f"{type} connected from {connection.address}")
+            elif type == _HEARTBEAT:
+                self.stats['heartbeats'] += 1
+            elif type == _LISTEN:
+                pattern = data[_TYPE_LENGTH.size:].decode('utf-8')
+                connection.listening.append(pattern)
+                self._log(f"{connection.name} listens to {pattern}")
+            elif type == _DISCONNECT:
+                self._close(connection)
+            else:
+                self.stats['messages'] += 1
+                self.stats['bytes'] += len(data)
+                if self.on_message is not None:
+                    self.on_message(connection.name, type, data, now)
+                self._forward(type, data)
+
+    def _forward(self, type, data):
+        encoded = None
+        for connection in list(self.connections.values()):
+            if any(_matches(pattern, type) for pattern in connection.listening):
+                if encoded is None:
+                    encoded = encode_message(type, data)
+                connection.outgoing += encoded
+                self._send(connection)
+
+    def _send(self, connection):
+        if connection.outgoing:
+            try:
+                sent = connection.socket.send(connection.outgoing)
+            except BlockingIOError:
+                sent = 0
+            del connection.outgoing[:sent]
+
+        # Only wait for room to write while there is something to write
+        events = selectors.EVENT_READ
+        if connection.outgoing:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(connection.socket, events)
+
+
+def main():
+    parser = ArgumentParser(prog='Messenger server',
+                            description='Local stand-in for the Messenger server ShuffleLog talks to TagTracker through')
+    parser.add_argument('--host', type=str, default='localhost', metavar='', help='Address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=5805, metavar='', help='Port to listen on')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print connects, disconnects and listens')
+
+    args = parser.parse_args()
+
+    server = MessengerServer(args.host, args.port, verbose=args.verbose).start()
+    print(f"Messenger server listening on {args.host}:{server.port}, Ctrl+C to stop")
+
+    # Report traffic once a second
+    last = dict(server.stats)
+    try:
+        while True:
+            time.sleep(1)
+            stats = dict(server.stats)
+            print(f"{len(server.clients())} clients, {stats['messages'] - last['messages']} messages/s, "
+                  f"{(stats['bytes'] - last['bytes']) / 1024:.1f} KiB/s, {stats['heartbeats'] - last['heartbeats']} heartbeats/s")
+            last = stats
+    except KeyboardInterrupt:
+        pass
+
+    server.stop()
+
+if __name__ == '__main__':
+    main()